@@ -0,0 +1,180 @@
+""" Text transport for Intcode programs which speak ASCII """
+
+from io import StringIO
+
+from intcode import Computer, StopReason
+
+
+class NullSink:
+    """ A text sink which discards everything written to it.
+
+    Any object with a `write(text)` method can act as a sink for an
+    `AsciiChannel`, e.g. `io.StringIO` to buffer or `sys.stdout` to echo.
+    """
+
+    def write(self, text: str):
+        """ Discard the text """
+
+    def flush(self):
+        """ Nothing to flush """
+
+
+class AsciiChannel:
+    """ Line and frame oriented text transport over an Intcode computer.
+
+    Outputs are pulled from the computer in bulk and decoded a chunk at a
+    time. Any output too large to be a character is kept as the `result`.
+
+    Args:
+        computer: the computer running an ASCII program
+
+    Keyword Args:
+        sink: receives all decoded output and sent input [NullSink()]
+        chunk_size: the maximum outputs to decode at a time [4096]
+    """
+
+    def __init__(self, computer: Computer, sink=None, chunk_size=4096):
+        self.computer = computer
+        self.sink = NullSink() if sink is None else sink
+        self.result = None
+        self._chunk_size = chunk_size
+        self._text = ""
+        self._blocked = False
+
+    def _pump(self) -> bool:
+        if self._blocked:
+            return False
+
+        stop = self.computer.run_until_blocked(self._chunk_size)
+        if stop.reason != StopReason.Output:
+            self._blocked = True
+
+        values = self.computer.read_all()
+        if not values:
+            return False
+
+        if max(values) > 255:
+            chars = []
+            for value in values:
+                if value > 255:
+                    self.result = value
+                else:
+                    chars.append(value)
+
+            values = chars
+
+        text = bytes(values).decode("latin-1")
+        self._text += text
+        self.sink.write(text)
+        return True
+
+    def _take(self, end: int, skip: int) -> str:
+        text = self._text[:end]
+        self._text = self._text[end + skip:]
+        return text
+
+    @property
+    def is_halted(self) -> bool:
+        """ Whether the program has halted and all its output been read """
+        return self.computer.is_halted and not self._text
+
+    def read_line(self) -> str:
+        """ Read the next line of output, without its newline.
+
+        Returns:
+            the line, any trailing partial line if the program blocks
+            before finishing it, or None if there is no more output
+        """
+        while True:
+            end = self._text.find("\n")
+            if end >= 0:
+                return self._take(end, 1)
+
+            if not self._pump():
+                break
+
+        if self._text:
+            return self._take(len(self._text), 0)
+
+        return None
+
+    def read_frame(self) -> str:
+        """ Read the next frame of output, terminated by a blank line.
+
+        Returns:
+            the frame text including the newline ending its last line, any
+            trailing partial frame, or None if there is no more output
+        """
+        while True:
+            end = self._text.find("\n\n")
+            if end >= 0:
+                return self._take(end + 1, 1)
+
+            if not self._pump():
+                break
+
+        if self._text:
+            return self._take(len(self._text), 0)
+
+        return None
+
+    def read_text(self, max_chars: int = None) -> str:
+        """ Read all output until the program blocks on input or halts.
+
+        Keyword Args:
+            max_chars: stop once at least this many characters have been
+                       read, for programs which may never block [None]
+        """
+        while (max_chars is None or len(self._text) < max_chars) and self._pump():
+            pass
+
+        return self._take(len(self._text), 0)
+
+    def send_lines(self, lines):
+        """ Send one or more lines of text as input to the program.
+
+        Args:
+            lines: a single line, or an iterable of lines, without newlines
+        """
+        if isinstance(lines, str):
+            lines = [lines]
+
+        text = "".join(line + "\n" for line in lines)
+        self.computer.write_all(text.encode("ascii"))
+        self.sink.write(text)
+        self._blocked = False
+
+
+def test_ascii_channel():
+    """ Tests line and frame reading and the non-ASCII result """
+    text = "ab\ncd\n\nef\n"
+    program = []
+    for char in text:
+        program.extend([104, ord(char)])
+
+    program.extend([104, 1000, 99])
+    sink = StringIO()
+    channel = AsciiChannel(Computer(program), sink, chunk_size=3)
+    assert channel.read_line() == "ab"
+    assert channel.read_frame() == "cd\n"
+    assert channel.read_line() == "ef"
+    assert channel.read_line() is None
+    assert channel.result == 1000
+    assert sink.getvalue() == text
+
+
+def test_ascii_channel_limit():
+    """ Tests reading from a program which never blocks """
+    channel = AsciiChannel(Computer([104, 97, 1105, 1, 0]), chunk_size=4)
+    text = channel.read_text(max_chars=10)
+    assert 10 <= len(text) < 14 and set(text) == {"a"}
+    assert not channel.computer.is_halted and not channel.computer.needs_input
+
+
+def test_ascii_channel_input():
+    """ Tests sending lines to a program that echoes them back """
+    program = [3, 100, 4, 100, 1005, 100, 0, 99]
+    channel = AsciiChannel(Computer(program))
+    assert channel.read_text() == ""
+    channel.send_lines(["hi", "yo"])
+    assert channel.read_text() == "hi\nyo\n"
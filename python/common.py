@@ -44,6 +44,28 @@ def read_tests(path: str) -> List[List[str]]:
     return tests
 
 
+def assemble(code: list) -> List[int]:
+    """ Resolve the labels in a hand-written Intcode program.
+
+    Args:
+        code: integers and strings, where a string ending in a colon, e.g.
+              "loop:", labels the address of the value after it, and any
+              other string, e.g. "loop", stands for that address
+
+    Returns:
+        the program
+    """
+    labels = {}
+    program = []
+    for value in code:
+        if isinstance(value, str) and value.endswith(":"):
+            labels[value[:-1]] = len(program)
+        else:
+            program.append(value)
+
+    return [labels.get(value, value) for value in program]
+
+
 def reconstruct_path(came_from, current):
     """ Reconsruct the optimal path """
     total_path = [current]
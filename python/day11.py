@@ -3,10 +3,11 @@
 from collections import namedtuple
 from enum import Enum
 
-import glasskey as gk
+import numpy as np
 
-from intcode import Computer
+from intcode import Computer, StopReason
 from common import asset
+from render import Rect, create_renderer
 
 ICONS = ['^', '>', 'v', '<']
 
@@ -29,7 +30,7 @@ class Direction(Enum):
     @property
     def icon(self):
         """ Return an icon for the direction """
-        return ICONS[int(self)]
+        return ICONS[self.value]
 
 
 class Tile(namedtuple("Tile", ["x", "y"])):
@@ -54,19 +55,158 @@ class Tile(namedtuple("Tile", ["x", "y"])):
 
 BLACK = 0
 WHITE = 1
+UNPAINTED = -1
+
+MOVES = [(0, -1), (1, 0), (0, 1), (-1, 0)]
+
+
+class Canvas:
+    """ A sparse canvas of painted tiles.
+
+    Colors are stored in square NumPy chunks which are only allocated when
+    a tile inside them is first painted, so memory is proportional to the
+    area the robot has touched. Bounds and the painted tile count are
+    maintained as tiles are painted.
+
+    Keyword Args:
+        chunk_bits: log2 of the side length of a chunk [6]
+    """
+
+    def __init__(self, chunk_bits=6):
+        self._bits = chunk_bits
+        self._mask = (1 << chunk_bits) - 1
+        self._chunks = {}
+        self._last_key = None
+        self._last_chunk = None
+        self.num_painted = 0
+        self._min = None
+        self._max = None
+
+    def _chunk(self, x, y, create):
+        key = (x >> self._bits, y >> self._bits)
+        if key == self._last_key:
+            return self._last_chunk
+
+        chunk = self._chunks.get(key)
+        if chunk is None:
+            if not create:
+                return None
+
+            size = 1 << self._bits
+            chunk = np.full((size, size), UNPAINTED, np.int8)
+            self._chunks[key] = chunk
+
+        self._last_key = key
+        self._last_chunk = chunk
+        return chunk
+
+    def __len__(self):
+        return self.num_painted
+
+    def color(self, x, y):
+        """ The color of a tile, which is black if it has never been painted """
+        chunk = self._chunk(x, y, False)
+        if chunk is None:
+            return BLACK
+
+        color = chunk[y & self._mask, x & self._mask]
+        return BLACK if color == UNPAINTED else int(color)
+
+    def paint(self, x, y, color):
+        """ Paint a tile """
+        chunk = self._chunk(x, y, True)
+        row = y & self._mask
+        col = x & self._mask
+        if chunk[row, col] == UNPAINTED:
+            self.num_painted += 1
+            if self._min is None:
+                self._min = [x, y]
+                self._max = [x, y]
+            else:
+                self._min[0] = min(self._min[0], x)
+                self._min[1] = min(self._min[1], y)
+                self._max[0] = max(self._max[0], x)
+                self._max[1] = max(self._max[1], y)
+
+        chunk[row, col] = color
+
+    def bounds(self) -> Rect:
+        """ The bounds of the painted tiles """
+        if self._min is None:
+            return Rect(0, 0, 0, 0)
+
+        return Rect(self._min[0], self._min[1],
+                    self._max[0] - self._min[0] + 1,
+                    self._max[1] - self._min[1] + 1)
+
+    def render(self, bounds: Rect = None) -> np.ndarray:
+        """ Render a region of the canvas.
+
+        Keyword Args:
+            bounds: the region to render [self.bounds()]
+
+        Returns:
+            a (height, width) array of colors, UNPAINTED where never painted
+        """
+        if bounds is None:
+            bounds = self.bounds()
+
+        image = np.full((bounds.height, bounds.width), UNPAINTED, np.int8)
+        size = 1 << self._bits
+        right = bounds.left + bounds.width
+        bottom = bounds.top + bounds.height
+        for (chunk_x, chunk_y), chunk in self._chunks.items():
+            left = chunk_x << self._bits
+            top = chunk_y << self._bits
+            x0 = max(left, bounds.left)
+            y0 = max(top, bounds.top)
+            x1 = min(left + size, right)
+            y1 = min(top + size, bottom)
+            if x0 < x1 and y0 < y1:
+                image[y0 - bounds.top:y1 - bounds.top, x0 - bounds.left:x1 - bounds.left] = \
+                    chunk[y0 - top:y1 - top, x0 - left:x1 - left]
+
+        return image
+
+
+def test_canvas():
+    """ Test painting, bounds and rendering across chunks """
+    canvas = Canvas(chunk_bits=2)
+    canvas.paint(0, 0, WHITE)
+    canvas.paint(-3, 5, BLACK)
+    canvas.paint(6, -1, WHITE)
+    canvas.paint(0, 0, BLACK)
+    assert len(canvas) == 3
+    assert canvas.color(6, -1) == WHITE
+    assert canvas.color(100, 100) == BLACK
+    assert canvas.bounds() == Rect(-3, -1, 10, 7)
+
+    image = canvas.render()
+    assert image.shape == (7, 10)
+    assert image[0, 9] == WHITE
+    assert image[1, 3] == BLACK
+    assert image[6, 0] == BLACK
+    assert (image == UNPAINTED).sum() == 67
 
 
 class Robot:
     """ Class representing the emergency hull painting robot """
 
     def __init__(self, initial_color=BLACK):
-        self.position = Tile(0, 0)
+        self.x = 0
+        self.y = 0
         self.direction = Direction.Up
-        self.painted = {Tile(0, 0): initial_color}
+        self.canvas = Canvas()
+        self.canvas.paint(0, 0, initial_color)
+
+    @property
+    def position(self):
+        """ The tile the robot is on """
+        return Tile(self.x, self.y)
 
     def paint(self, color):
         """ Paint a color onto a tile """
-        self.painted[self.position] = color
+        self.canvas.paint(self.x, self.y, color)
 
     def move(self, turn):
         """ Turn and move the robot """
@@ -75,74 +215,75 @@ class Robot:
         else:
             self.direction = self.direction.widdershins()
 
-        self.position = self.position.move(self.direction)
+        delta_x, delta_y = MOVES[self.direction.value]
+        self.x += delta_x
+        self.y += delta_y
 
     def camera(self):
         """ Take a photo from the camera """
-        if self.position in self.painted:
-            return self.painted[self.position]
-
-        return BLACK
+        return self.canvas.color(self.x, self.y)
 
 
 def _run_program(robot, program):
     computer = Computer(program)
     computer.write(robot.camera())
-    while not computer.is_halted:
-        computer.step()
-        if computer.num_outputs == 2:
+    while True:
+        stop = computer.run_until_blocked()
+        while computer.num_outputs >= 2:
             robot.paint(computer.read())
             robot.move(computer.read())
-            computer.write(robot.camera())
 
-def _bounds(robot):
-    x_values = set([tile.x for tile in robot.painted])
-    y_values = set([tile.y for tile in robot.painted])
+        if stop.reason == StopReason.Halted:
+            break
 
-    min_x = min(x_values)
-    min_y = min(y_values)
-    width = max(x_values) - min_x + 1
-    height = max(y_values) - min_y + 1
+        computer.write(robot.camera())
 
-    return gk.Rect(0, 0, width, height)
 
+def _draw_tile(renderer, robot, x, y):
+    renderer.draw(y, x, '#' if robot.canvas.color(x, y) else '.')
 
-def _draw(grid, robot):
-    grid.clear(_bounds(robot))
 
-    for tile, color in robot.painted.items():
-        grid.draw(tile.y, tile.x, '#' if color else '.')
+def _to_text(image):
+    chars = np.where(image == WHITE, '#', '.')
+    return ["".join(row) for row in chars]
 
-    grid.draw(robot.position.y, robot.position.x, robot.direction.icon)
 
-    grid.blit()
-
-def _run_program_animated(robot, program):
-    grid = gk.create_grid(6, 43, "Painting Robot")
-    gk.start()
+def _run_program_animated(robot, program, headless=False):
+    renderer = create_renderer(6, 43, "Painting Robot", headless)
 
     computer = Computer(program)
     computer.write(robot.camera())
-    _draw(grid, robot)
-    input("Press enter to begin...")
-
-    while not computer.is_halted:
-        computer.step()
-        if computer.num_outputs == 2:
+    renderer.draw(robot.y, robot.x, robot.direction.icon)
+    renderer.present(force=True)
+    if not headless:
+        input("Press enter to begin...")
+
+    while True:
+        stop = computer.run_until_blocked()
+        while computer.num_outputs >= 2:
             robot.paint(computer.read())
+            _draw_tile(renderer, robot, robot.x, robot.y)
             robot.move(computer.read())
-            computer.write(robot.camera())
-            _draw(grid, robot)
-            gk.next_frame()
+            renderer.draw(robot.y, robot.x, robot.direction.icon)
+            renderer.present()
+
+        if stop.reason == StopReason.Halted:
+            break
+
+        computer.write(robot.camera())
+
+    renderer.present(force=True)
+    if not headless:
+        input("Press any key to finish...")
+
+    renderer.close()
 
-    input("Press any key to finish...")
-    gk.stop()
 
 def _part1(program):
     robot = Robot()
     _run_program(robot, program)
 
-    print("Part 1:", len(robot.painted))
+    print("Part 1:", len(robot.canvas))
 
 
 def _part2(program, animated=False):
@@ -154,15 +295,8 @@ def _part2(program, animated=False):
 
     print("Part 2:")
 
-    bounds = _bounds(robot)
-
-    text = [['.'] * bounds.width for _ in range(bounds.height)]
-
-    for tile, color in robot.painted.items():
-        text[tile.y][tile.x] = '#' if color else '.'
-
-    for line in text:
-        print("".join(line))
+    for line in _to_text(robot.canvas.render()):
+        print(line)
 
 
 def _main():
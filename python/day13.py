@@ -1,12 +1,13 @@
 """ Solution to Day 13 """
 
-from collections import namedtuple
 from enum import IntEnum
 
-from intcode import Computer
-import glasskey as gk
+import numpy as np
+import pytest
 
-from common import asset
+from intcode import Computer, StopReason
+from common import asset, assemble
+from render import Rect, create_renderer
 
 TILE_CHARS = [' ', '#', '8', '=', 'o']
 
@@ -20,62 +21,166 @@ class TileId(IntEnum):
     Ball = 4
 
 
-class Tile(namedtuple("Tile", ["x", "y", "tile_id"])):
-    """ Class representing a tile on the game screen """
+class Screen:
+    """ The game screen, updated in bulk from the computer's output.
 
-    def __repr__(self):
-        return TILE_CHARS[self.tile_id.value]
+    Tiles are held in a NumPy array. Each update applies a whole batch of
+    (x, y, tile_id) triples with vectorized assignment, keeping the block
+    count, the ball and paddle positions and the score up to date, and
+    records which cells changed.
+    """
 
+    def __init__(self):
+        self.tiles = np.zeros((0, 0), np.uint8)
+        self.score = 0
+        self.num_blocks = 0
+        self.ball = None
+        self.paddle = None
+        self.dirty_cells = (np.zeros(0, np.int64), np.zeros(0, np.int64))
 
-def _run_game(program, use_ai=True, playable=False):
+    @property
+    def dirty(self) -> Rect:
+        """ The bounds of the cells changed by the last update """
+        rows, cols = self.dirty_cells
+        if not len(rows):
+            return Rect(0, 0, 0, 0)
+
+        return Rect(int(cols.min()), int(rows.min()),
+                    int(cols.max() - cols.min() + 1),
+                    int(rows.max() - rows.min() + 1))
+
+    def _fit(self, height, width):
+        if height <= self.tiles.shape[0] and width <= self.tiles.shape[1]:
+            return
+
+        tiles = np.zeros((max(height, self.tiles.shape[0]),
+                          max(width, self.tiles.shape[1])), np.uint8)
+        tiles[:self.tiles.shape[0], :self.tiles.shape[1]] = self.tiles
+        self.tiles = tiles
+
+    def update(self, outputs):
+        """ Apply a batch of output triples to the screen """
+        triples = np.asarray(outputs, np.int64).reshape(-1, 3)
+        is_score = triples[:, 0] == -1
+        if is_score.any():
+            self.score = int(triples[is_score][-1, 2])
+
+        triples = triples[~is_score]
+        if not len(triples):
+            self.dirty_cells = (np.zeros(0, np.int64), np.zeros(0, np.int64))
+            return
+
+        cols, rows, tile_ids = triples.T
+        for tile_id, name in ((TileId.Ball, "ball"), (TileId.Paddle, "paddle")):
+            positions = np.nonzero(tile_ids == tile_id)[0]
+            if len(positions):
+                index = positions[-1]
+                setattr(self, name, (int(cols[index]), int(rows[index])))
+
+        self._fit(rows.max() + 1, cols.max() + 1)
+
+        # only the last write to each cell in the batch counts
+        width = self.tiles.shape[1]
+        cells = rows * width + cols
+        _, last = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - last
+        cells = cells[last]
+        tile_ids = tile_ids[last].astype(np.uint8)
+
+        flat = self.tiles.reshape(-1)
+        old = flat[cells]
+        changed = old != tile_ids
+        self.num_blocks += int(np.count_nonzero(tile_ids == TileId.Block))
+        self.num_blocks -= int(np.count_nonzero(old == TileId.Block))
+        flat[cells] = tile_ids
+        self.dirty_cells = np.divmod(cells[changed], width)
+
+
+def test_screen():
+    """ Test bulk screen updates """
+    screen = Screen()
+    screen.update([0, 0, 1, 1, 0, 2, 2, 0, 2, 1, 2, 4, 3, 2, 3, -1, 0, 7])
+    assert screen.tiles.shape == (3, 4)
+    assert screen.num_blocks == 2
+    assert screen.ball == (1, 2)
+    assert screen.paddle == (3, 2)
+    assert screen.score == 7
+
+    screen.update([1, 2, 0, 1, 0, 0, 1, 0, 4, 2, 0, 0, 2, 0, 2])
+    assert screen.num_blocks == 1
+    assert screen.ball == (1, 0)
+    assert screen.dirty == Rect(1, 0, 1, 3)
+    assert screen.tiles[0].tolist() == [1, 4, 2, 0]
+
+
+BLOCK_COLORS = [(5, "Purple"), (8, "Red"), (11, "Orange"),
+                (14, "Yellow"), (17, "Green")]
+
+JOYSTICK = {"Left": -1, "Right": 1, "Space": 0}
+
+
+def _block_color(y):
+    for limit, color in BLOCK_COLORS:
+        if y < limit:
+            return color
+
+    return "Blue"
+
+
+def _read_joystick(renderer):
+    while any(renderer.is_pressed(key) for key in JOYSTICK):
+        renderer.present()
+
+    while True:
+        for key, value in JOYSTICK.items():
+            if renderer.is_pressed(key):
+                return value
+
+        renderer.present()
+
+
+def _draw(renderer, screen):
+    for row, col in zip(*screen.dirty_cells):
+        tile_id = screen.tiles[row, col]
+        if tile_id == TileId.Block:
+            renderer.draw(row+2, col, TILE_CHARS[tile_id], _block_color(row))
+        else:
+            renderer.draw(row+2, col, TILE_CHARS[tile_id])
+
+    renderer.draw(0, 0, str(screen.score))
+    renderer.present()
+
+
+def _run_game(program, use_ai=True, playable=False, headless=None):
+    if headless is None:
+        headless = use_ai and not playable
+
+    if headless and not use_ai:
+        raise ValueError("A game without the AI needs a window to read the joystick")
+
+    program = program.copy()
     program[0] = 2
     computer = Computer(program)
 
-    gk.start()
-    grid = gk.create_grid(28, 46, "Breakout")
-    grid.map_color(TILE_CHARS[TileId.Wall], gk.Colors.Gray)
-    grid.map_color(TILE_CHARS[TileId.Paddle], gk.Colors.Magenta)
-    grid.map_color(TILE_CHARS[TileId.Ball], gk.Colors.Magenta)
-
-    paddle_x = 0
-    ball_x = 0
-    score = 0
-    pressed = False
-    while not computer.is_halted:
-        while not computer.needs_input and not computer.is_halted:
-            computer.step()
-            if computer.num_outputs == 3:
-                x = computer.read()
-                y = computer.read()
-                if x > -1:
-                    tile_id = TileId(computer.read())
-                    if tile_id == TileId.Block:
-                        if y < 5:
-                            color = gk.Colors.Purple
-                        elif y < 8:
-                            color = gk.Colors.Red
-                        elif y < 11:
-                            color = gk.Colors.Orange
-                        elif y < 14:
-                            color = gk.Colors.Yellow
-                        elif y < 17:
-                            color = gk.Colors.Green
-                        else:
-                            color = gk.Colors.Blue
-
-                        grid.draw(y+2, x, [gk.Letter(TILE_CHARS[TileId.Block], color)])
-                    else:
-                        if tile_id == TileId.Paddle:
-                            paddle_x = x
-                        elif tile_id == TileId.Ball:
-                            ball_x = x
-
-                        grid.draw(y+2, x, TILE_CHARS[tile_id])
-                else:
-                    score = computer.read()
-                    grid.draw(0, 0, str(score))
-
-        if use_ai:
+    renderer = create_renderer(28, 46, "Breakout", headless, paced=playable)
+    renderer.map_color(TILE_CHARS[TileId.Wall], "Gray")
+    renderer.map_color(TILE_CHARS[TileId.Paddle], "Magenta")
+    renderer.map_color(TILE_CHARS[TileId.Ball], "Magenta")
+
+    screen = Screen()
+    while True:
+        stop = computer.run_until_blocked()
+        screen.update(computer.read_all())
+        if not headless:
+            _draw(renderer, screen)
+
+        if stop.reason == StopReason.Halted:
+            break
+
+        if use_ai and (screen.paddle is None or screen.ball is None):
+            computer.write(0)
+        elif use_ai:
+            (paddle_x, _), (ball_x, _) = screen.paddle, screen.ball
             if paddle_x < ball_x:
                 computer.write(1)
             elif paddle_x > ball_x:
@@ -83,45 +188,178 @@ def _run_game(program, use_ai=True, playable=False):
             else:
                 computer.write(0)
         else:
-            if gk.is_pressed(gk.Key.Left):
-                if not pressed:
-                    computer.write(-1)
-                    pressed = True
-            elif gk.is_pressed(gk.Key.Right):
-                if not pressed:
-                    computer.write(1)
-                    pressed = True
-            elif gk.is_pressed(gk.Key.Space):
-                if not pressed:
-                    computer.write(0)
-                    pressed = True
-            else:
-                pressed = False
+            computer.write(_read_joystick(renderer))
+
+    renderer.close()
+
+    return screen.score
+
+
+def test_run_game_headless():
+    """ Test that a headless game cannot be played by hand """
+    with pytest.raises(ValueError):
+        _run_game([99], use_ai=False, headless=True)
+
+
+def _predict_landing(computer, ball, row, batch=16):
+    """ Predict where the ball will next arrive on the row above the paddle.
+
+    A fork of the game is played ahead with the joystick held still. The
+    ball moves once per frame, so frames are counted from its updates.
+
+    Returns:
+        (frames, x) for the first arrival, or for the last ball position
+        if the game halts before the ball arrives
+    """
+    fork = computer.fork()
+    frames = 0
+    x, y = ball
+    while True:
+        fork.write_all([0] * batch)
+        stop = fork.run_until_blocked()
+        outputs = fork.read_all()
+        for tile_x, tile_y, value in zip(outputs[0::3], outputs[1::3], outputs[2::3]):
+            if tile_x > -1 and value == TileId.Ball:
+                frames += 1
+                if tile_y == row and y < row:
+                    return frames, tile_x
+
+                x, y = tile_x, tile_y
+
+        if stop.reason == StopReason.Halted:
+            return frames, x
+
+
+def _joystick_inputs(paddle_x, frames, target_x):
+    """ The joystick inputs which bring the paddle to a column in a number
+    of frames, holding still first and moving last.
+
+    Returns:
+        the inputs, or None if the paddle cannot get there in time
+    """
+    distance = target_x - paddle_x
+    moves = abs(distance)
+    if moves >= frames:
+        return None
+
+    direction = (distance > 0) - (distance < 0)
+    return [0] * (frames - moves) + [direction] * moves
+
 
-        grid.blit()
-        if playable:
-            gk.next_frame()
+def _breakout(num_hits, wait=False):
+    """ A game without blocks, where the ball bounces between columns 1 and
+    7 from (2, 3), heading down and right, and must land on the paddle on
+    row 8 `num_hits` times. The game halts as soon as the ball is missed,
+    and if `wait` is set, asks for an input before drawing anything. """
+    paddle_x, ball_x, ball_y, dx, dy, joystick, temp, temp2, score = range(200, 209)
+    draw = [4, paddle_x, 104, 8, 104, TileId.Paddle, 4, ball_x, 4, ball_y,
+            104, TileId.Ball, 104, -1, 104, 0, 4, score]
+    code = [1101, 0, 0, temp] + ([3, joystick] if wait else []) + draw + [
+        "loop:", 3, joystick, 1, paddle_x, joystick, paddle_x,
+        1, ball_x, dx, ball_x, 1, ball_y, dy, ball_y,
+        1008, ball_x, 1, temp, 1008, ball_x, 7, temp2, 1, temp, temp2, temp,
+        1006, temp, "top", 1002, dx, -1, dx,
+        "top:", 1008, ball_y, 1, temp, 1006, temp, "paddle", 1101, 1, 0, dy,
+        "paddle:", 1008, ball_y, 7, temp, 1006, temp, "draw",
+        8, paddle_x, ball_x, temp, 1005, temp, "hit",
+        4, ball_x, 4, ball_y, 104, TileId.Ball, 99,
+        "hit:", 1101, -1, 0, dy, 1001, score, 1, score,
+        "draw:"] + draw + [1008, score, num_hits, temp, 1006, temp, "loop", 99]
+    program = assemble(code)
+    program += [0] * (200 - len(program))
+    program += [4, 2, 3, 1, 1, 0, 0, 0, 0]
+    return program
 
-    gk.stop()
 
-    return score
+def test_predict_landing():
+    """ Test that the paddle meets the predicted landing, and only if it
+    holds still first and moves last """
+    computer = Computer(_breakout(3))
+    computer.run_until_blocked()
+    screen = Screen()
+    screen.update(computer.read_all())
+    assert screen.paddle == (4, 8)
+    assert screen.ball == (2, 3)
+
+    ticks = computer.instruction_count
+    frames, target_x = _predict_landing(computer, screen.ball, 7)
+    assert (frames, target_x) == (4, 6)
+    assert computer.instruction_count == ticks
+
+    inputs = _joystick_inputs(4, frames, target_x)
+    assert inputs == [0, 0, 1, 1]
+    assert _joystick_inputs(4, 2, target_x) is None
+
+    late = computer.fork()
+    late.write_all([0] + inputs)
+    assert late.run_until_blocked().reason == StopReason.Halted
+
+    computer.write_all(inputs)
+    assert computer.run_until_blocked().reason == StopReason.Input
+    screen.update(computer.read_all())
+    assert screen.score == 1
+    assert screen.paddle == (6, 8)
+    assert _predict_landing(computer, screen.ball, 7) == (12, 6)
+
+    assert _solve_game(_breakout(3)) == (3, 4)
+
+
+def test_input_before_tiles():
+    """ Test games which ask for input before drawing the paddle and ball """
+    assert _solve_game(_breakout(3, wait=True)) == (3, 5)
+    assert _run_game(_breakout(3, wait=True)) == _run_game(_breakout(3))
+
+
+def _solve_game(program):
+    """ Play the game headless, moving the paddle in batches.
+
+    Each time the game needs input, a fork predicts where the ball will
+    next reach the paddle, and enough joystick inputs to meet it there are
+    written at once. The joystick input while the ball sits on the paddle
+    decides its bounce, and the fork assumes it is held still, so the
+    paddle holds still first and moves last. If there is no time to spare
+    for that, a single input following the ball is written instead.
+    The program may be any variant of the game.
+
+    Returns:
+        (score, round_trips) where round_trips counts the runs of the game
+        between batches of input
+    """
+    program = program.copy()
+    program[0] = 2
+    computer = Computer(program)
+    screen = Screen()
+    round_trips = 0
+    while True:
+        stop = computer.run_until_blocked()
+        round_trips += 1
+        screen.update(computer.read_all())
+        if stop.reason == StopReason.Halted:
+            return screen.score, round_trips
+
+        if screen.paddle is None or screen.ball is None:
+            computer.write(0)
+            continue
+
+        (paddle_x, paddle_y), (ball_x, _) = screen.paddle, screen.ball
+        frames, target_x = _predict_landing(computer, screen.ball, paddle_y - 1)
+        inputs = _joystick_inputs(paddle_x, frames, target_x)
+        if inputs is not None:
+            computer.write_all(inputs)
+        else:
+            follow = ball_x - paddle_x
+            computer.write((follow > 0) - (follow < 0))
 
 
 def _main():
     with open(asset("day13.txt")) as file:
         program = [int(code) for code in file.read().split(',')]
 
-    tiles = []
     computer = Computer(program)
-    while not computer.is_halted:
-        computer.step()
-        if computer.num_outputs == 3:
-            x = computer.read()
-            y = computer.read()
-            tile_id = TileId(computer.read())
-            tiles.append(Tile(x, y, tile_id))
-
-    print("Part 1:", sum([tile.tile_id == TileId.Block for tile in tiles]))
+    computer.run_until_blocked()
+    screen = Screen()
+    screen.update(computer.read_all())
+    print("Part 1:", screen.num_blocks)
 
     score = _run_game(program)
     print("Part 2:", score)
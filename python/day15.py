@@ -1,14 +1,15 @@
 """ Solution for day 15 """
 
-from collections import namedtuple
+import multiprocessing
+from collections import deque, namedtuple
 from enum import IntEnum
 
 import numpy as np
+import pytest
 
 from intcode import Computer
-from common import asset, a_star, Vector, Neighbors
-
-import glasskey as gk
+from common import asset, assemble, a_star, Vector, Neighbors
+from render import Rect, create_renderer
 
 
 Directions = [
@@ -18,6 +19,9 @@ Directions = [
     Vector(1, 0)
 ]
 
+REVERSE = {1: 2, 2: 1, 3: 4, 4: 3}
+
+
 def _to_command(vec):
     return Directions.index(vec) + 1
 
@@ -29,13 +33,79 @@ class Status(IntEnum):
     OxygenSystem = 2
 
 
-def _to_numpy(vectors):
-    result = np.zeros((len(vectors), 2), np.int32)
-    for i, vector in enumerate(vectors):
-        result[i, 0] = vector.x
-        result[i, 1] = vector.y
+UNKNOWN = -1
+
+
+class SectorGrid(namedtuple("SectorGrid", ["cells", "origin", "oxygen_system"])):
+    """ Dense representation of a sector.
 
-    return result
+    Attributes:
+        cells: (height, width) int8 array of `Status` values, or UNKNOWN
+        origin: the sector location of cells[0, 0]
+        oxygen_system: the sector location of the oxygen system
+    """
+
+    def save(self, file):
+        """ Saves the grid to file """
+        np.savez(file, cells=self.cells, origin=np.array(self.origin, np.int32),
+                 oxygen_system=np.array(self.oxygen_system, np.int32))
+
+    @staticmethod
+    def load(file):
+        """ Loads a grid from file """
+        data = np.load(file)
+        return SectorGrid(data["cells"], Vector(*data["origin"].tolist()),
+                          Vector(*data["oxygen_system"].tolist()))
+
+    def to_sector(self):
+        """ Converts the grid to a sparse sector """
+        def _locations(mask):
+            rows, cols = np.nonzero(mask)
+            return {Vector(int(col) + self.origin.x, int(row) + self.origin.y)
+                    for row, col in zip(rows, cols)}
+
+        return Sector(_locations(self.cells == Status.Wall),
+                      _locations(self.cells > Status.Wall),
+                      self.oxygen_system)
+
+    def distances(self, start):
+        """ Compute the walking distance from a location to every cell.
+
+        The breadth first search advances a whole frontier at a time by
+        shifting boolean masks in each of the four directions.
+
+        Returns:
+            an int32 array of distances, -1 where unreachable
+        """
+        passable = self.cells > Status.Wall
+        distance = np.full(self.cells.shape, -1, np.int32)
+        frontier = np.zeros(self.cells.shape, bool)
+        pos = start - self.origin
+        frontier[pos.y, pos.x] = True
+        visited = frontier.copy()
+        distance[frontier] = 0
+        steps = 0
+        while frontier.any():
+            steps += 1
+            grown = np.zeros_like(frontier)
+            grown[1:] |= frontier[:-1]
+            grown[:-1] |= frontier[1:]
+            grown[:, 1:] |= frontier[:, :-1]
+            grown[:, :-1] |= frontier[:, 1:]
+            frontier = grown & passable & ~visited
+            visited |= frontier
+            distance[frontier] = steps
+
+        return distance
+
+    def fill(self):
+        """ The minutes taken for oxygen to fill the sector """
+        return int(self.distances(self.oxygen_system).max())
+
+    def steps_to_oxygen(self, start=Vector(0, 0)):
+        """ The number of steps from a location to the oxygen system """
+        pos = start - self.origin
+        return int(self.distances(self.oxygen_system)[pos.y, pos.x])
 
 
 class Sector(namedtuple("Sector", ["walls", "empty", "oxygen_system"])):
@@ -43,11 +113,21 @@ class Sector(namedtuple("Sector", ["walls", "empty", "oxygen_system"])):
 
     def save(self, file):
         """ Saves the sector information to file """
-        walls = _to_numpy(self.walls)
-        empty = _to_numpy(self.empty)
-        oxygen_system = np.array(self.oxygen_system, np.int32)
-        np.savez(file, walls=walls, empty=empty,
-                 oxygen_system=oxygen_system)
+        self.to_grid().save(file)
+
+    def to_grid(self):
+        """ Converts the sector to a dense grid covering its bounds """
+        bounds = self.bounds()
+        cells = np.full((bounds.height, bounds.width), UNKNOWN, np.int8)
+        origin = Vector(bounds.left, bounds.top)
+        for status, locations in ((Status.Wall, self.walls), (Status.Empty, self.empty)):
+            if locations:
+                locs = np.array(list(locations), np.int32)
+                cells[locs[:, 1] - origin.y, locs[:, 0] - origin.x] = status
+
+        pos = self.oxygen_system - origin
+        cells[pos.y, pos.x] = Status.OxygenSystem
+        return SectorGrid(cells, origin, self.oxygen_system)
 
     def bounds(self):
         """ The bounds of the sector """
@@ -58,25 +138,21 @@ class Sector(namedtuple("Sector", ["walls", "empty", "oxygen_system"])):
 
         width = max_x - min_x + 1
         height = max_y - min_y + 1
-        return gk.Rect(min_x, min_y, width, height)
+        return Rect(min_x, min_y, width, height)
 
     @staticmethod
     def load(file):
         """ Loads the sector information from file """
-        data = np.load(file)
-        walls = [Vector(*loc) for loc in data["walls"]]
-        empty = [Vector(*loc) for loc in data["empty"]]
-        oxygen_system = Vector(*data["oxygen_system"])
-        return Sector(walls, empty, oxygen_system)
+        return SectorGrid.load(file).to_sector()
 
     def fill(self, step_cb=None):
         """ Fill the sector with oxygen """
-        frontier = [(0, self.oxygen_system)]
+        frontier = deque([(0, self.oxygen_system)])
 
         oxygen = set()
         max_minutes = 0
         while frontier:
-            minute, loc = frontier.pop(0)
+            minute, loc = frontier.popleft()
             if loc in self.walls or loc in oxygen:
                 continue
 
@@ -160,6 +236,55 @@ class RepairDrone:
 
         return Sector(self._walls, self._empty, self._oxygen_system)
 
+    def explore_dfs(self):
+        """ Explore the sector depth first, backtracking along the drone's path.
+
+        Every command moves to or probes a neighbor of the current location,
+        so each cell is entered once and left once.
+
+        Returns:
+            a sector map
+        """
+        self._walls = set()
+        self._empty = {self.location}
+        self._oxygen_system = None
+        path = []
+        while True:
+            for command, direction in enumerate(Directions, 1):
+                target = self.location + direction
+                if target in self._walls or target in self._empty:
+                    continue
+
+                status = self.send(command)
+                if status == Status.Wall:
+                    self._walls.add(target)
+                    continue
+
+                if status == Status.OxygenSystem:
+                    self._oxygen_system = target
+
+                self._empty.add(target)
+                self.move(direction)
+                path.append(command)
+                break
+            else:
+                if not path:
+                    break
+
+                command = REVERSE[path.pop()]
+                self.send(command)
+                self.move(Directions[command-1])
+
+        return Sector(self._walls, self._empty, self._oxygen_system)
+
+    def send(self, command):
+        """ Send a movement command to the drone program.
+
+        Returns:
+            the status reported by the drone
+        """
+        return _send(self._cpu, command)
+
     def move(self, direction):
         """ Move the drone in the specified direction """
         self.location += direction
@@ -184,83 +309,348 @@ class RepairDrone:
 
         status = Status.Empty
         for command in commands:
-            while not self._cpu.needs_input:
-                self._cpu.step()
-
-            self._cpu.write(command)
-            while not self._cpu.num_outputs:
-                self._cpu.step()
-
-            status = self._cpu.read()
+            status = self.send(command)
             if status != Status.Wall:
                 self.move(Directions[command-1])
 
-        return Status(status)
+        return status
+
+
+TEST = """ ##
+#..##
+#.#..#
+#.O.#
+ ###
+"""
+
+
+def test_sector_grid(tmp_path):
+    """ Test the grid distance field and save/load round trip """
+    walls = set()
+    empty = set()
+    oxygen_system = None
+    for y, line in enumerate(TEST.splitlines()):
+        for x, char in enumerate(line):
+            loc = Vector(x - 1, y - 1)
+            if char == '#':
+                walls.add(loc)
+            elif char in '.O':
+                empty.add(loc)
+                if char == 'O':
+                    oxygen_system = loc
+
+    sector = Sector(walls, empty, oxygen_system)
+    grid = sector.to_grid()
+    assert grid.fill() == 4 == sector.fill()
+    assert grid.steps_to_oxygen() == 3 == sector.steps_to_oxygen()
+
+    path = str(tmp_path / "sector.npz")
+    sector.save(path)
+    loaded = Sector.load(path)
+    assert loaded == sector
+    np.testing.assert_array_equal(SectorGrid.load(path).cells, grid.cells)
+
+
+def _send(computer, command):
+    computer.write(command)
+    computer.run_until_blocked(max_outputs=1)
+    return Status(computer.read())
+
+
+def _expand(branches, known, budget):
+    """ Expand exploration branches breadth first, forking at every cell.
+
+    Each branch is a computer whose drone stands at the branch location.
+    Every unknown neighbor is probed on a fork of that computer, so no
+    drone ever has to walk back, and each open neighbor becomes a branch.
+    Expanded branches are removed from `branches`, new ones are appended,
+    and the cells found are added to `known`.
+
+    Returns:
+        (walls, empty, oxygen_system) found while expanding `budget` branches
+    """
+    walls = set()
+    empty = set()
+    oxygen_system = None
+    for _ in range(budget):
+        if not branches:
+            break
+
+        computer, location = branches.popleft()
+        for command, direction in enumerate(Directions, 1):
+            target = location + direction
+            if target in known:
+                continue
+
+            known.add(target)
+            fork = computer.fork()
+            status = _send(fork, command)
+            if status == Status.Wall:
+                walls.add(target)
+                continue
+
+            if status == Status.OxygenSystem:
+                oxygen_system = target
+
+            empty.add(target)
+            branches.append((fork, target))
+
+    return walls, empty, oxygen_system
+
+
+class _Partition:
+    """ The part of the frontier owned by one worker, and its view of the map """
 
+    def __init__(self, budget):
+        self.budget = budget
+        self.branches = deque()
+        self.known = set()
 
-def _explore_animation(program, sector):
+    def round(self, cells, dropped, branches, give):
+        """ Take in the cells found elsewhere, expand, and give away branches.
+
+        Args:
+            cells: cells found by other partitions since the last round
+            dropped: locations of branches which another partition claimed
+            branches: branches handed over from another partition
+            give: the number of branches to hand over
+
+        Returns:
+            (walls, empty, oxygen_system, remaining, given)
+        """
+        self.known |= cells
+        if dropped:
+            self.branches = deque(branch for branch in self.branches
+                                  if branch[1] not in dropped)
+
+        for branch in branches:
+            self.known.add(branch[1])
+            self.branches.append(branch)
+
+        walls, empty, oxygen_system = _expand(self.branches, self.known, self.budget)
+        given = [self.branches.pop() for _ in range(min(give, len(self.branches) // 2))]
+        return walls, empty, oxygen_system, len(self.branches), given
+
+
+def _partition_worker(budget, inbox, outbox):
+    partition = _Partition(budget)
+    while True:
+        message = inbox.get()
+        if message is None:
+            return
+
+        outbox.put(partition.round(*message))
+
+
+def explore_forked(program, workers=4, processes=True, budget=32):
+    """ Explore the sector on forked computers spread across workers.
+
+    Each worker owns a part of the frontier for the whole exploration, and
+    keeps its own copy of the map. After each round of expansion only the
+    newly found cells are passed on to the other workers. A cell found by
+    more than one worker in a round is kept by the first, and workers which
+    run out of branches are handed part of the largest partition.
+
+    Args:
+        program: the drone program
+
+    Keyword Args:
+        workers: the number of workers [4]
+        processes: run each worker in a process of its own, rather than
+                   running them in turn in this process [True]
+        budget: branches each worker expands per round [32]
+
+    Returns:
+        a sector map
+    """
+    walls = set()
+    empty = {Vector(0, 0)}
+    oxygen_system = None
+    messages = [(set(), set(), [], 0) for _ in range(workers)]
+    messages[0] = (set(), set(), [(Computer(program), Vector(0, 0))], 0)
+    if processes:
+        inboxes = [multiprocessing.Queue() for _ in range(workers)]
+        outboxes = [multiprocessing.Queue() for _ in range(workers)]
+        pool = [multiprocessing.Process(target=_partition_worker,
+                                        args=(budget, inbox, outbox), daemon=True)
+                for inbox, outbox in zip(inboxes, outboxes)]
+        for process in pool:
+            process.start()
+    else:
+        partitions = [_Partition(budget) for _ in range(workers)]
+
+    try:
+        while True:
+            if processes:
+                for inbox, message in zip(inboxes, messages):
+                    inbox.put(message)
+
+                results = [outbox.get() for outbox in outboxes]
+            else:
+                results = [partition.round(*message)
+                           for partition, message in zip(partitions, messages)]
+
+            owners = {}
+            for index, (new_walls, new_empty, found, _, _) in enumerate(results):
+                for cell in new_walls | new_empty:
+                    owners.setdefault(cell, index)
+
+                walls |= new_walls
+                empty |= new_empty
+                oxygen_system = found or oxygen_system
+
+            remaining = [result[3] for result in results]
+            handed = [branch for result in results for branch in result[4]]
+            if not any(remaining) and not handed:
+                break
+
+            assigned = [[] for _ in range(workers)]
+            for branch in handed:
+                index = min(range(workers), key=remaining.__getitem__)
+                assigned[index].append(branch)
+                remaining[index] += 1
+
+            idle = remaining.count(0)
+            donor = max(range(workers), key=remaining.__getitem__)
+            messages = []
+            for index, (_, new_empty, _, _, _) in enumerate(results):
+                cells = {cell for cell, owner in owners.items() if owner != index}
+                dropped = {cell for cell in new_empty if owners[cell] != index}
+                give = idle if index == donor else 0
+                messages.append((cells, dropped, assigned[index], give))
+    finally:
+        if processes:
+            for inbox in inboxes:
+                inbox.put(None)
+
+            for process in pool:
+                process.join()
+
+    return Sector(walls, empty, oxygen_system)
+
+
+def _maze_program(maze):
+    """ A drone program for a maze drawn with '#' walls, 'O' for the oxygen
+    system and 'D' for the drone """
+    num_cols = len(maze[0])
+    x, y, next_x, next_y, temp, index, command, negative = range(500, 508)
+    grid = 1000
+    code = [3, command,
+            1001, x, 0, next_x, 1001, y, 0, next_y,
+            1008, command, 1, temp, 1005, temp, "north",
+            1008, command, 2, temp, 1005, temp, "south",
+            1008, command, 3, temp, 1005, temp, "west",
+            1001, next_x, 1, next_x, 1105, 1, "check",
+            "north:", 1001, next_y, -1, next_y, 1105, 1, "check",
+            "south:", 1001, next_y, 1, next_y, 1105, 1, "check",
+            "west:", 1001, next_x, -1, next_x,
+            "check:", 1002, next_y, num_cols, index, 1, index, next_x, index,
+            1001, index, grid, index, 9, index, 1201, 0, 0, temp,
+            1002, index, -1, negative, 9, negative,
+            4, temp, 1006, temp, 0,
+            1001, next_x, 0, x, 1001, next_y, 0, y, 1105, 1, 0]
+    program = assemble(code)
+    program += [0] * (grid + len(maze) * num_cols - len(program))
+    for row, line in enumerate(maze):
+        for col, char in enumerate(line):
+            program[grid + row * num_cols + col] = "#.O".find(char) if char != 'D' else 1
+            if char == 'D':
+                program[x], program[y] = col, row
+
+    return program
+
+
+MAZE = """#########
+#...#..O#
+#.#.#.###
+#.#...#.#
+#.###.#.#
+#...D...#
+#########""".split()
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_explore_forked(processes):
+    """ Test that forked exploration maps the same sector as depth first """
+    program = _maze_program(MAZE)
+    expected = RepairDrone(program).explore_dfs()
+    assert len(expected.empty) == 24
+    sector = explore_forked(program, workers=3, processes=processes, budget=2)
+    assert sector == expected
+    assert sector.steps_to_oxygen() == 7
+
+
+def _explore_animation(program, sector, headless=False):
     bounds = sector.bounds()
-    gk.start()
-    grid = gk.create_grid(bounds.height, bounds.width, "Repair Droid")
-    grid.map_color('#', gk.Colors.Red)
-    grid.map_color('D', gk.Colors.White)
-    grid.map_color('.', gk.Colors.Gray)
-    grid.map_color('O', gk.Colors.Blue)
+    renderer = create_renderer(bounds.height, bounds.width, "Repair Droid", headless)
+    renderer.map_color('#', "Red")
+    renderer.map_color('D', "White")
+    renderer.map_color('.', "Gray")
+    renderer.map_color('O', "Blue")
     offset = Vector(bounds.left, bounds.top)
+    previous = [Vector(0, 0)]
+
+    def _draw_tile(tile, walls, empty, oxygen_system):
+        if tile == oxygen_system:
+            char = 'O'
+        elif tile in walls:
+            char = '#'
+        elif tile in empty:
+            char = '.'
+        else:
+            return
 
-    def _move_cb(location, walls, empty, oxygen_system):
-        for tile in walls:
-            pos = tile - offset
-            grid.draw(pos.y, pos.x, "#")
-
-        for tile in empty:
-            pos = tile - offset
-            grid.draw(pos.y, pos.x, '.')
+        pos = tile - offset
+        renderer.draw(pos.y, pos.x, char)
 
-        if oxygen_system:
-            pos = oxygen_system - offset
-            grid.draw(pos.y, pos.x, 'O')
+    def _move_cb(location, walls, empty, oxygen_system):
+        for tile in previous[0].neighbors() | location.neighbors() | {previous[0]}:
+            _draw_tile(tile, walls, empty, oxygen_system)
 
         pos = location - offset
-        grid.draw(pos.y, pos.x, "D")
+        renderer.draw(pos.y, pos.x, "D")
+        renderer.present()
+        previous[0] = location
 
-        grid.blit()
-        gk.next_frame(30)
+    if not headless:
+        input("Press enter to start animation...")
 
-    input("Press enter to start animation...")
     robot = RepairDrone(program, move_cb=_move_cb)
-    robot.explore()
-    gk.stop()
+    robot.explore_dfs()
+    renderer.close()
 
 
-def _fill_animation(sector):
+def _fill_animation(sector, headless=False):
     bounds = sector.bounds()
-    gk.start()
-    grid = gk.create_grid(bounds.height, bounds.width, "Oxygen Fill")
-    grid.map_color('#', gk.Colors.Red)
-    grid.map_color('.', gk.Colors.Gray)
-    grid.map_color('O', gk.Colors.Blue)
+    renderer = create_renderer(bounds.height, bounds.width, "Oxygen Fill", headless)
+    renderer.map_color('#', "Red")
+    renderer.map_color('.', "Gray")
+    renderer.map_color('O', "Blue")
     offset = Vector(bounds.left, bounds.top)
 
-    def _step_cb(walls, empty, oxygen):
-        for tile in walls:
-            pos = tile - offset
-            grid.draw(pos.y, pos.x, "#")
+    for tile in sector.walls:
+        pos = tile - offset
+        renderer.draw(pos.y, pos.x, "#")
 
-        for tile in empty:
-            pos = tile - offset
-            grid.draw(pos.y, pos.x, '.')
+    for tile in sector.empty:
+        pos = tile - offset
+        renderer.draw(pos.y, pos.x, '.')
+
+    drawn = set()
 
-        for tile in oxygen:
+    def _step_cb(walls, empty, oxygen):
+        for tile in oxygen - drawn:
             pos = tile - offset
-            grid.draw(pos.y, pos.x, 'O')
+            renderer.draw(pos.y, pos.x, 'O')
+
+        drawn.update(oxygen)
+        renderer.present()
 
-        grid.blit()
-        gk.next_frame(30)
+    if not headless:
+        input("Press enter to start animation...")
 
-    input("Press enter to start animation...")
     sector.fill(step_cb=_step_cb)
-    gk.stop()
+    renderer.close()
 
 
 def _main():
@@ -268,10 +658,11 @@ def _main():
         program = [int(code) for code in file.read().split(',')]
 
     robot = RepairDrone(program)
-    sector = robot.explore()
+    sector = robot.explore_dfs()
     sector.draw()
-    print("Part 1:", sector.steps_to_oxygen())
-    print("Part 2:", sector.fill())
+    grid = sector.to_grid()
+    print("Part 1:", grid.steps_to_oxygen())
+    print("Part 2:", grid.fill())
 
     #_explore_animation(program, sector)
     # _fill_animation(sector)
@@ -2,11 +2,13 @@
 
 import sys
 from collections import namedtuple
-from io import StringIO
 
-from intcode import Computer
+import numpy as np
+
+from intcode import Computer, StopReason
+from ascii_channel import AsciiChannel
 from common import asset, Vector
-import glasskey as gk
+from render import create_renderer
 
 
 class Position(Vector):
@@ -108,14 +110,227 @@ class Robot:
             self.add_segment(end - start)
 
 
+FUNCTION_NAMES = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def compress(commands, num_functions=3, max_chars=20, max_main_chars=None):
+    """ Find encodings of a command list as a main routine and functions.
+
+    Backtracks over positions in the command list, at each one either
+    calling a function which matches there or defining a new one, and
+    remembers (position, functions, calls) states which led nowhere.
+    Functions are numbered in the order in which they are first called.
+
+    Args:
+        commands: the run-length command list, e.g. ["R", "8", "L", "4"]
+
+    Keyword Args:
+        num_functions: the maximum number of functions [3]
+        max_chars: the character limit of each function [20]
+        max_main_chars: the character limit of the main routine [max_chars]
+
+    Yields:
+        (main, functions) where main is a list of function indices and
+        functions a list of command lists
+    """
+    if max_main_chars is None:
+        max_main_chars = max_chars
+
+    tokens = tuple(commands)
+    max_calls = (max_main_chars + 1) // 2
+    dead = set()
+    main = []
+
+    def _choices(pos, functions):
+        for index, function in enumerate(functions):
+            end = pos + len(function)
+            if tokens[pos:end] == function:
+                yield index, end, functions
+
+        if len(functions) < num_functions:
+            length = -1
+            for end in range(pos + 1, len(tokens) + 1):
+                length += len(tokens[end - 1]) + 1
+                if length > max_chars:
+                    break
+
+                function = tokens[pos:end]
+                if function not in functions:
+                    yield len(functions), end, functions + (function,)
+
+    # each frame is [key, choices, found], and the stack stands in for
+    # recursion so that the number of calls is not bound by the stack depth
+    stack = []
+    pos, functions = 0, ()
+    while True:
+        key = (pos, functions, len(main))
+        if pos == len(tokens):
+            yield list(main), [list(function) for function in functions]
+            if stack:
+                stack[-1][2] = True
+        elif len(main) < max_calls and key not in dead:
+            stack.append([key, _choices(pos, functions), False])
+
+        choice = None
+        while stack:
+            frame = stack[-1]
+            choice = next(frame[1], None)
+            if choice is not None:
+                break
+
+            stack.pop()
+            if not frame[2]:
+                dead.add(frame[0])
+            elif stack:
+                stack[-1][2] = True
+
+        if not stack:
+            return
+
+        index, pos, functions = choice
+        del main[frame[0][2]:]
+        main.append(index)
+
+
+def shortest_encoding(commands, num_functions=3, max_chars=20, max_main_chars=None):
+    """ The encoding with the fewest characters in total, or None """
+    def _length(encoding):
+        main, functions = encoding
+        return 2 * len(main) + sum(len(",".join(function)) + 1 for function in functions)
+
+    encodings = compress(commands, num_functions, max_chars, max_main_chars)
+    return min(encodings, key=_length, default=None)
+
+
+PATH = "R,8,R,8,R,4,R,4,R,8,L,6,L,2,R,4,R,4,R,8,R,8,R,8,L,6,L,2"
+
+
+def test_compress():
+    """ Test """
+    commands = PATH.split(',')
+    encodings = list(compress(commands))
+    assert encodings
+    for main, functions in encodings:
+        assert sum((functions[index] for index in main), []) == commands
+        assert len(main) <= 10
+        assert all(len(",".join(function)) <= 20 for function in functions)
+
+    main, functions = shortest_encoding(commands)
+    assert (main, functions) in encodings
+    assert shortest_encoding(commands, 1, 20) is None
+
+
+def test_compress_long():
+    """ Test that long paths are not bound by the recursion limit """
+    commands = ["R", "8", "L", "4"] * 2250
+    main, functions = next(compress(commands, max_main_chars=len(commands) * 2))
+    assert sum((functions[index] for index in main), []) == commands
+
+
+NEWLINE = ord('\n')
+
+
+class CameraFeed:
+    """ Decodes the camera output of a computer into frames.
+
+    Outputs are pulled from the computer in bulk and split on blank lines.
+    Blocks which form a rectangular grid become frames, and anything else,
+    like the movement prompts, is kept as text in `messages`.
+
+    Args:
+        computer: the computer producing the video feed
+
+    Keyword Args:
+        chunk_size: the maximum outputs to pull at a time [65536]
+    """
+
+    def __init__(self, computer: Computer, chunk_size=65536):
+        self.computer = computer
+        self.messages = []
+        self.result = None
+        self._chunk_size = chunk_size
+
+    def _pump(self):
+        stop = self.computer.run_until_blocked(self._chunk_size)
+        values = np.array(self.computer.read_all(), np.int64)
+        large = values > 255
+        if large.any():
+            self.result = int(values[large][-1])
+            values = values[~large]
+
+        return stop.reason == StopReason.Output, values.astype(np.uint8)
+
+    def _decode(self, block):
+        if block[-1] != NEWLINE:
+            block = np.append(block, np.uint8(NEWLINE))
+
+        width = int(np.argmax(block == NEWLINE))
+        stride = width + 1
+        if width and block.size % stride == 0:
+            if np.count_nonzero(block == NEWLINE) == block.size // stride:
+                return block.reshape(-1, stride)[:, :width]
+
+        self.messages.append(block.tobytes().decode("ascii"))
+        return None
+
+    def frames(self, skip=0):
+        """ Generate the frames of the feed.
+
+        Keyword Args:
+            skip: the number of frames to drop after each one yielded [0]
+
+        Yields:
+            each frame as a (rows, cols) uint8 array of character codes
+        """
+        buffer = np.zeros(0, np.uint8)
+        index = 0
+        running = True
+        while running:
+            running, values = self._pump()
+            buffer = np.concatenate((buffer, values))
+            newlines = np.flatnonzero(buffer == NEWLINE)
+            start = 0
+            for end in newlines[1:][np.diff(newlines) == 1]:
+                block = buffer[start:end]
+                start = end + 1
+                if block.size == 0:
+                    continue
+
+                frame = self._decode(block)
+                if frame is not None:
+                    if index % (skip + 1) == 0:
+                        yield frame
+
+                    index += 1
+
+            buffer = buffer[start:]
+
+        if buffer.size:
+            frame = self._decode(buffer)
+            if frame is not None and index % (skip + 1) == 0:
+                yield frame
+
+
+def test_camera_feed():
+    """ Test """
+    text = "Main:\nVideo?\n\n#.\n.#\n\n..\n##\n\n##\n#.\n\n"
+    values = [ord(char) for char in text] + [1234]
+    program = sum(([104, value] for value in values), []) + [99]
+    feed = CameraFeed(Computer(program), chunk_size=5)
+    frames = list(feed.frames())
+    assert feed.messages == ["Main:\nVideo?\n"]
+    assert feed.result == 1234
+    assert len(frames) == 3
+    assert frames[0].dtype == np.uint8
+    assert frames[1].tobytes() == b"..##"
+
+    feed = CameraFeed(Computer(program))
+    assert [frame.tobytes() for frame in feed.frames(skip=1)] == [b"#..#", b"###."]
+
+
 class Routine(namedtuple("Routine", ("main", "sub_a", "sub_b", "sub_c"))):
     """ A vacuum robot movement routine """
 
-    @staticmethod
-    def _principal_period(s):
-        i = (s+s).find(s, 1, -1)
-        return None if i == -1 else s[:i]
-
     @staticmethod
     def _to_list(commands):
         if isinstance(commands, str):
@@ -130,26 +345,6 @@ class Routine(namedtuple("Routine", ("main", "sub_a", "sub_b", "sub_c"))):
 
         return " ".join(routine)
 
-    @staticmethod
-    def _to_text(routine):
-        parts = routine.split()
-        text = []
-        count = 0
-        for part in parts:
-            if part in ('R', 'L', 'A', 'B', 'C'):
-                if count:
-                    text.append(str(count))
-                    count = 0
-
-                text.append(part)
-            else:
-                count += 1
-
-        if count:
-            text.append(str(count))
-
-        return ",".join(text)
-
     def _animation_labels(self, robot):
         routine = self._to_list(robot.commands)
         sub_a = self._to_list(self.sub_a)
@@ -162,124 +357,87 @@ class Routine(namedtuple("Routine", ("main", "sub_a", "sub_b", "sub_c"))):
         return list(zip(robot.order, labels))
 
     @staticmethod
-    def create(commands):
+    def create(commands, max_chars=20):
         """ Create a movement routine from the raw command list """
-        routine = ",".join(commands)
-        routine = Routine._to_list(routine) + " "
-        parts = routine.split()
-        max_length = len(parts) // 2
-        for i in range(4, max_length):
-            sub_a = " ".join(parts[:i]) + " "
-            if routine.find(sub_a) == routine.rfind(sub_a):
-                break
-
-            routine_a = routine.replace(sub_a, "")
-            for j in range(4, max_length):
-                sub_b = " ".join(parts[-j:]) + " "
-                if routine.find(sub_b) == routine.rfind(sub_b):
-                    break
-
-                routine_ab = routine_a.replace(sub_b, "")
-                sub_c = Routine._principal_period(routine_ab)
-                if sub_c:
-                    main = routine.replace(sub_a, "A ")
-                    main = main.replace(sub_b, "B ")
-                    main = main.replace(sub_c, "C ")
-                    main = main.strip().replace(' ', ',') + '\n'
-                    if len(main) <= 20:
-                        sub_a = Routine._to_text(sub_a) + '\n'
-                        sub_b = Routine._to_text(sub_b) + '\n'
-                        sub_c = Routine._to_text(sub_c) + '\n'
-                        return Routine(main, sub_a, sub_b, sub_c)
+        encoding = next(compress(commands, 3, max_chars), None)
+        if encoding is None:
+            return None
 
-        return None
+        main, functions = encoding
+        functions += [functions[0]] * (3 - len(functions))
+        return Routine(",".join(FUNCTION_NAMES[index] for index in main) + '\n',
+                       *[",".join(function) + '\n' for function in functions])
 
-    def run(self, program):
+    def run(self, program, sink=None):
         """ Run the movement routine on the robot """
+        if sink is None:
+            sink = sys.stdout
+
         program = program.copy()
         program[0] = 2
-        computer = Computer(program)
-
-        while not computer.needs_input:
-            computer.step()
+        channel = AsciiChannel(Computer(program), sink)
+        channel.read_text()
+        channel.send_lines([part.strip() for part in self] + ["n"])
+        channel.read_text()
+        return channel.result
 
-        for char in "".join(self) + "n\n":
-            computer.write(ord(char))
+    def _video_feed(self, program):
+        program = program.copy()
+        program[0] = 2
+        channel = AsciiChannel(Computer(program))
+        channel.read_text()
+        channel.send_lines([part.strip() for part in self] + ["y"])
+        return CameraFeed(channel.computer)
 
-        val = None
-        while not computer.is_halted:
-            while not computer.num_outputs:
-                computer.step()
+    def record(self, program, skip=0):
+        """ Record the continuous video feed of the routine.
 
-            val = computer.read()
-            if val < 255:
-                sys.stdout.write(chr(val))
+        Keyword Args:
+            skip: the number of frames to drop after each one kept [0]
 
-        return val
+        Returns:
+            (frames, result) where frames is a (count, rows, cols) uint8 array
+        """
+        feed = self._video_feed(program)
+        frames = np.stack(list(feed.frames(skip)))
+        return frames, feed.result
 
     @staticmethod
-    def draw(grid, lines, labels, frame):
+    def draw(renderer, frame, labels, index):
         """ Draw the routine as it animates """
-        if frame < 0:
-            return
-
-        for tile, label in labels[:frame]:
-            lines[tile.y][tile.x] = label
+        frame = frame.copy()
+        for tile, label in labels[:index]:
+            frame[tile.y, tile.x] = ord(label)
 
-        for row, line in enumerate(lines):
-            grid.draw(row, 0, "".join(line))
+        for row, line in enumerate(frame):
+            renderer.draw(row, 0, line.tobytes().decode("ascii"))
 
-        grid.blit()
-        gk.next_frame()
+        renderer.present()
 
-    def animate(self, program, robot):
+    def animate(self, program, robot, headless=False):
         """ Animate the routine """
         labels = self._animation_labels(robot)
-        program = program.copy()
-        program[0] = 2
-        computer = Computer(program)
-
-        while not computer.needs_input:
-            computer.step()
+        feed = self._video_feed(program)
 
-        for char in "".join(self) + "y\n":
-            computer.write(ord(char))
-
-        gk.start()
         rows = 37
         cols = 45
-        grid = gk.create_grid(rows, cols, "Vacuum Robot")
-        grid.map_color('.', gk.Colors.Navy)
-        grid.map_color('#', gk.Colors.Gray)
-        grid.map_color('A', gk.Colors.Red)
-        grid.map_color('B', gk.Colors.Green)
-        grid.map_color('C', gk.Colors.Blue)
-        lines = [[' ']*cols for _ in range(rows)]
-        row = 0
-        col = 0
-        frame = -2
-        input("Press enter to begin animation...")
-        while not computer.is_halted:
-            while not computer.num_outputs:
-                computer.step()
-
-            val = computer.read()
-            if val < 255:
-                if val == ord('\n'):
-                    if col:
-                        row += 1
-                        col = 0
-                    else:
-                        self.draw(grid, lines, labels, frame)
-                        row = 0
-                        col = 0
-                        frame += 1
-                else:
-                    lines[row][col] = chr(val)
-                    col += 1
-
-        self.draw(grid, lines, labels, frame)
-        gk.stop()
+        renderer = create_renderer(rows, cols, "Vacuum Robot", headless)
+        renderer.map_color('.', "Navy")
+        renderer.map_color('#', "Gray")
+        renderer.map_color('A', "Red")
+        renderer.map_color('B', "Green")
+        renderer.map_color('C', "Blue")
+        if not headless:
+            input("Press enter to begin animation...")
+
+        frame = None
+        for index, frame in enumerate(feed.frames()):
+            self.draw(renderer, frame, labels, index)
+
+        if frame is not None:
+            self.draw(renderer, frame, labels, len(labels))
+
+        renderer.close()
 
 
 def _parse_scaffolds(text):
@@ -308,6 +466,30 @@ def _sum_of_alignment_parameters(scaffolds):
                 for intersection in _find_intersections(scaffolds)])
 
 
+def _scaffold_grid(text):
+    """ Decode a camera frame straight into a boolean grid of scaffolds """
+    lines = text.strip('\n')
+    width = lines.find('\n')
+    if width < 0:
+        width = len(lines)
+
+    data = np.frombuffer((lines + '\n').encode("ascii"), np.uint8)
+    return data.reshape(-1, width + 1)[:, :width] != ord('.')
+
+
+def _intersections(grid):
+    """ Mask of the scaffolds with scaffolds on all four sides """
+    mask = np.zeros_like(grid)
+    mask[1:-1, 1:-1] = (grid[1:-1, 1:-1] & grid[:-2, 1:-1] & grid[2:, 1:-1]
+                        & grid[1:-1, :-2] & grid[1:-1, 2:])
+    return mask
+
+
+def _alignment_sum(grid):
+    rows, cols = np.nonzero(_intersections(grid))
+    return int(np.dot(rows.astype(np.int64), cols.astype(np.int64)))
+
+
 TEST = """..#..........
 ..#..........
 #######...###
@@ -322,26 +504,15 @@ def test_sum_alignment_params():
     """ Test """
     scaffolds, _ = _parse_scaffolds(TEST)
     assert _sum_of_alignment_parameters(scaffolds) == 76
+    assert _alignment_sum(_scaffold_grid(TEST)) == 76
 
 
-def _ascii(program):
-    computer = Computer(program)
-
-    last = None
-    output = StringIO()
-    while not computer.is_halted:
-        while not computer.num_outputs:
-            computer.step()
-
-        tile = chr(computer.read())
-        if last == tile == '\n':
-            break
+def _ascii(program, sink=None):
+    if sink is None:
+        sink = sys.stdout
 
-        last = tile
-        output.write(tile)
-        sys.stdout.write(tile)
-
-    return output.getvalue()
+    channel = AsciiChannel(Computer(program), sink)
+    return channel.read_frame()
 
 
 def _main():
@@ -350,8 +521,9 @@ def _main():
 
     text = _ascii(program)
 
+    print("Part 1:", _alignment_sum(_scaffold_grid(text)))
+
     scaffolds, robot = _parse_scaffolds(text)
-    print("Part 1:", _sum_of_alignment_parameters(scaffolds))
 
     robot.follow_scaffolds(scaffolds)
     routine = Routine.create(robot.commands)
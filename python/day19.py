@@ -1,6 +1,8 @@
 """ Solution for Day 19 """
 
+import multiprocessing
 from collections import namedtuple
+from functools import partial
 
 import numpy as np
 
@@ -11,158 +13,292 @@ from intcode import Computer
 class Vector(namedtuple("Vector", ["x", "y"])):
     """ 2D Vector """
 
-    @property
-    def command(self):
-        """ The command needed to move in a direction """
-        return Directions.index(self) + 1
 
-    def __add__(self, other):
-        return Vector(self.x + other.x, self.y + other.y)
+def _move_test(computer, x, y):
+    computer.reset()
+    computer.write_all((x, y))
+    computer.run_until_blocked(max_outputs=1)
+    return computer.read()
 
-    def __sub__(self, other):
-        return Vector(self.x - other.x, self.y - other.y)
 
-    def __truediv__(self, other):
-        return Vector(self.x / other, self.y / other)
+def _scan_block(computer, xs, ys):
+    scan = np.zeros((len(ys), len(xs)), np.uint8)
+    for row, y in enumerate(ys):
+        for col, x in enumerate(xs):
+            scan[row, col] = _move_test(computer, x, y)
 
-    @property
-    def length(self):
-        """ L1 length of the vector """
-        return abs(self.x) + abs(self.y)
+    return scan
 
 
-Directions = [
-    Vector(0, -1),
-    Vector(0, 1),
-    Vector(-1, 0),
-    Vector(1, 0)
-]
+_WORKER_COMPUTER = None
 
-UP = 0
-DOWN = 1
-LEFT = 2
-RIGHT = 3
 
+def _init_worker(program):
+    global _WORKER_COMPUTER
+    _WORKER_COMPUTER = Computer(program)
 
-def _move_test(computer, x, y):
-    computer.reset()
-    computer.run_to_input()
-    computer.write(x)
-    computer.write(y)
-    computer.run_to_output()
-    return computer.read()
 
+def _scan_rows(task):
+    xs, rows, ys = task
+    return rows, _scan_block(_WORKER_COMPUTER, xs, ys)
 
-def _scan_emitter(computer, left, top, width, height):
-    scan = np.zeros((width, height), np.uint8)
 
-    for x in range(0, width):
-        for y in range(0, height):
-            scan[y, x] = _move_test(computer, left + x, top + y)
+def area_scan(program, x_range, y_range, processes=None, rows_per_task=4):
+    """ Probe every cell of a rectangle across worker processes.
 
-    return scan
+    Each worker builds a computer once, when it starts, and then scans
+    batches of rows, which are sent back as arrays.
 
+    Args:
+        program: the drone program
+        x_range: the columns to scan, e.g. range(50)
+        y_range: the rows to scan
 
-def _walk_top(computer, start, end):
-    current = start
-    sequence = []
-    while current.x < end and current.y < end:
-        sequence.append(current)
-        right = current + Directions[RIGHT]
-        if _move_test(computer, right.x, right.y):
-            current = right
-        else:
-            current = current + Directions[DOWN]
+    Keyword Args:
+        processes: the number of worker processes, or 1 to scan in this
+                   process [os.cpu_count()]
+        rows_per_task: the number of rows sent to a worker at a time [4]
 
-    return sequence
+    Returns:
+        a (len(y_range), len(x_range)) uint8 array, 1 where the beam is
+    """
+    xs = list(x_range)
+    ys = list(y_range)
+    if processes == 1:
+        return _scan_block(Computer(program), xs, ys)
 
+    scan = np.zeros((len(ys), len(xs)), np.uint8)
+    tasks = [(xs, slice(start, start + rows_per_task), ys[start:start + rows_per_task])
+             for start in range(0, len(ys), rows_per_task)]
+    with multiprocessing.Pool(processes, _init_worker, (program,)) as pool:
+        for rows, block in pool.imap_unordered(_scan_rows, tasks):
+            scan[rows] = block
 
-def _walk_bottom(computer, start, end):
-    current = start
-    sequence = []
-    while current.x < end and current.y < end:
-        sequence.append(current)
-        down = current + Directions[DOWN]
-        if _move_test(computer, down.x, down.y):
-            current = down
-        else:
-            current = current + Directions[RIGHT]
+    return scan
 
-    return sequence
 
+def test_area_scan():
+    """ Test """
+    # outputs whether x == y
+    program = [3, 100, 3, 101, 8, 100, 101, 102, 4, 102, 99]
+    expected = np.zeros((5, 3), np.uint8)
+    expected[1:4, :] = np.eye(3, dtype=np.uint8)
+    for processes in (1, 2):
+        scan = area_scan(program, range(3), range(-1, 4), processes, rows_per_task=2)
+        assert scan.shape == (5, 3)
+        assert (scan == expected).all()
 
-def _principal_period(s):
-    i = (s+s).find(s, 1, -1)
-    return None if i == -1 else s[:i]
 
+class BeamTracker:
+    """ Tracks the edges of the tractor beam row by row.
 
-def _line(points):
-    mean = sum(points, Vector(0, 0)) / len(points)
-    norm_points = [point - mean for point in points]
-    sum_xy = sum(point.x*point.y for point in norm_points)
-    sum_xx = sum(point.x*point.x for point in norm_points)
-    slope = sum_xy / sum_xx
-    intercept = mean.y - slope*mean.x
-    return slope, intercept
+    Each row of the beam is a single run of cells between a first and a last
+    column, both of which only move right as the rows go down, so each edge
+    is found by probing on from where it was in the row above.
+
+    Args:
+        in_beam: function (x, y) -> whether the cell is in the beam
+
+    Keyword Args:
+        start: the first row to track, skipping any gaps near the emitter [10]
+
+    Attributes:
+        num_probes: the number of cells probed
+        num_fallbacks: the rows `search_edges` had to track row by row
+    """
+
+    def __init__(self, in_beam, start=10):
+        self.num_probes = 0
+        self.num_fallbacks = 0
+        self._in_beam = in_beam
+        self._rows = {}
+        self._start = start
+        self._last_row = None
+
+    def probe(self, x: int, y: int) -> bool:
+        """ Whether a cell is in the beam """
+        self.num_probes += 1
+        return bool(self._in_beam(x, y))
+
+    def _find_row(self, y):
+        for x in range(10*y + 10):
+            if self.probe(x, y):
+                last = x
+                while self.probe(last + 1, y):
+                    last += 1
+
+                return x, last
+
+        return None
+
+    def edges(self, y: int):
+        """ The first and last columns of the beam in a row.
+
+        Rows after the start are tracked from the row above.
+
+        Returns:
+            (first, last), or None if the row is empty
+        """
+        if y in self._rows:
+            return self._rows[y]
+
+        if y <= self._start:
+            self._rows[y] = self._find_row(y)
+            return self._rows[y]
+
+        if self._last_row is None:
+            while not self.edges(self._start):
+                self._start += 1
+
+            self._last_row = self._start
+
+        while self._last_row < y:
+            first, last = self._rows[self._last_row]
+            row = self._last_row + 1
+            while not self.probe(first, row):
+                first += 1
+
+            last = max(last, first)
+            while self.probe(last + 1, row):
+                last += 1
+
+            self._rows[row] = first, last
+            self._last_row = row
+
+        return self._rows[y]
+
+    def _gallop(self, x, y, step):
+        while self.probe(x + step, y):
+            x += step
+            step *= 2
+
+        lower, upper = x, x + step
+        while abs(upper - lower) > 1:
+            middle = (lower + upper) // 2
+            if self.probe(middle, y):
+                lower = middle
+            else:
+                upper = middle
+
+        return lower
+
+    def search_edges(self, y: int):
+        """ The edges of a row found by galloping and binary search.
+
+        Uses a number of probes logarithmic in the width of the beam,
+        without tracking any of the rows above. The search starts from where
+        the beam is expected to be from the start row, and if that misses,
+        the row is tracked from the rows above instead, which is counted in
+        `num_fallbacks`.
+
+        Returns:
+            (first, last), or None if the row is empty
+        """
+        if y in self._rows:
+            return self._rows[y]
+
+        self.edges(self._start + 1)
+        first, last = self._rows[self._start]
+        x = y*(first + last) // (2*self._start)
+        if not self.probe(x, y):
+            self.num_fallbacks += 1
+            return self.edges(y)
+
+        edges = self._gallop(x, y, -1), self._gallop(x, y, 1)
+        self._rows[y] = edges
+        return edges
+
+    def _fits(self, size, bottom, edges):
+        bottom_edges = edges(bottom)
+        top = bottom - size + 1
+        if top < self._start:
+            return False
+
+        top_edges = edges(top)
+        return top_edges[1] - bottom_edges[0] + 1 >= size
+
+    def first_square(self, size: int, gallop=False) -> Vector:
+        """ Find the square closest to the emitter which fits in the beam.
+
+        The square fits if the beam in its bottom row starts far enough
+        left of where the beam in its top row ends.
+
+        Args:
+            size: the length of the sides of the square
+
+        Keyword Args:
+            gallop: find rows by galloping and binary search instead of
+                    tracking every row, for very large squares [False]
+
+        Returns:
+            the top left corner of the square
+        """
+        # skip any empty rows at the start before searching from there
+        self.edges(self._start + 1)
+        if not gallop:
+            bottom = self._start + size - 1
+            while not self._fits(size, bottom, self.edges):
+                bottom += 1
+        else:
+            edges = self.search_edges
+            lower = self._start + size - 1
+            upper = 2*lower
+            while not self._fits(size, upper, edges):
+                lower, upper = upper, 2*upper
 
+            while upper - lower > 1:
+                middle = (lower + upper) // 2
+                if self._fits(size, middle, edges):
+                    upper = middle
+                else:
+                    lower = middle
 
-def _estimate_box_from_lines(computer, size):
-    top = _walk_top(computer, Vector(13, 16), 50)
-    bottom = _walk_bottom(computer, Vector(13, 16), 50)
+            # each edge is rounded by less than a cell, so a row can only
+            # fit below one which does not if the beam widens by less than
+            # two cells from one to the other
+            first, last = self._rows[upper]
+            window = 2*upper // max(last - first, 1) + 1
+            bottom = upper
+            for row in range(lower, lower - window, -1):
+                if self._fits(size, row, edges):
+                    bottom = row
 
-    m0, b0 = _line(top)
-    m1, b1 = _line(bottom)
+        return Vector(self._rows[bottom][0], bottom - size + 1)
 
-    y0 = b1 - (m1/m0)*b0 - size*m1 - size
-    y0 /= 1 - (m1/m0)
-    x0 = (y0 - b0)/m0
-    y1 = y0 + size
-    x1 = x0 - size
 
-    top_right = Vector(int(x0), int(y0))
-    bottom_left = Vector(int(x1), int(y1))
-    return top_right, bottom_left
+def _cone(x, y):
+    return 5*x <= 7*y <= 11*x
 
 
-def _get_samples_around_estimate(computer, estimate, search, is_top):
-    estimate -= Vector(search//2, search//2)
-    scan = _scan_emitter(computer, estimate.x, estimate.y, search, search)
+def _narrow_cone(x, y):
+    """ A cone with gaps in its rows near the emitter, including row 10 """
+    return 17072*x <= 10000*y <= 19918*x and x > 0
 
-    samples = []
-    for y, x in np.transpose(np.nonzero(scan)):
-        if x == search-1 or y == search-1:
-            continue
 
-        loc = Vector(x, y)
-        if is_top:
-            up = loc + Directions[UP]
-            right = loc + Directions[RIGHT]
-            if scan[up.y, up.x] and scan[right.y, right.x]:
-                continue
-        else:
-            down = loc + Directions[DOWN]
-            left = loc + Directions[LEFT]
-            if not(scan[left.y, left.x] == 0 or scan[down.y, down.x] == 0):
-                continue
+def _brute_force_square(in_beam, size):
+    for top in range(200):
+        for left in range(200):
+            if all(in_beam(left + dx, top + dy)
+                   for dx in range(size) for dy in range(size)):
+                return Vector(left, top)
 
-        samples.append(loc + estimate)
+    return None
 
-    return samples
 
+def test_beam_tracker():
+    """ Test """
+    for in_beam, size in ((_cone, 6), (_narrow_cone, 3)):
+        expected = _brute_force_square(in_beam, size)
+        assert BeamTracker(in_beam).first_square(size) == expected
+        assert BeamTracker(in_beam).first_square(size, True) == expected
 
-def _find_location(computer, size=100, search=30):
-    top_right, bottom_left = _estimate_box_from_lines(computer, size)
-    top = _get_samples_around_estimate(computer, top_right, search, True)
-    bottom = _get_samples_around_estimate(computer, bottom_left, search, True)
-    candidates = []
-    for top_right in top:
-        for bottom_left in bottom:
-            width = top_right.x - bottom_left.x + 1
-            height = bottom_left.y - top_right.y + 1
-            if width == size and height == size:
-                candidates.append(Vector(bottom_left.x, top_right.y))
+    assert not BeamTracker(_narrow_cone).edges(10)
 
-    return min(candidates, key=lambda vec: vec.length)
+    tracker = BeamTracker(_cone)
+    corner = tracker.first_square(1000, True)
+    assert tracker.num_probes < 3000
+    assert tracker.num_fallbacks == 0
+    assert corner == BeamTracker(_cone).first_square(1000)
 
 
 def _main():
@@ -171,10 +307,11 @@ def _main():
 
     computer = Computer(program)
 
-    scan = _scan_emitter(computer, 0, 0, 50, 50)
+    scan = area_scan(program, range(50), range(50))
     print("Part 1:", scan.sum())
 
-    loc = _find_location(computer)
+    tracker = BeamTracker(partial(_move_test, computer))
+    loc = tracker.first_square(100, gallop=True)
     print("Part 2:", loc.x*10000 + loc.y)
 
 
@@ -1,7 +1,12 @@
 """ Solution to day 21 """
 
+import os
+from collections import namedtuple
+from io import StringIO
+
 from common import asset
 from intcode import Computer
+from ascii_channel import AsciiChannel
 
 ASSEMBLER0 = """OR A T
 AND B T
@@ -23,18 +28,403 @@ RUN
 """
 
 
-def _run_assembler(program, assembler):
-    computer = Computer(program)
-    while not computer.needs_input:
-        computer.step()
+def _run_assembler(program, assembler, sink=None):
+    channel = AsciiChannel(Computer(program), sink)
+    channel.read_text()
+    channel.send_lines(assembler.splitlines())
+    channel.read_text()
+    return channel.result
+
+
+SENSORS = "ABCDEFGHI"
+NUM_PATTERNS = 1 << len(SENSORS)
+ALL_PATTERNS = (1 << NUM_PATTERNS) - 1
+SENSOR_MASKS = {sensor: sum(1 << pattern for pattern in range(NUM_PATTERNS)
+                            if pattern >> index & 1)
+                for index, sensor in enumerate(SENSORS)}
+MODES = {"WALK": SENSORS[:4], "RUN": SENSORS}
+MAX_INSTRUCTIONS = 15
+
+
+def evaluate(script: str) -> int:
+    """ Evaluate a springscript against every sensor pattern at once.
+
+    Bit n of a pattern is whether sensor n (A, B, ...) sees ground, and each
+    register holds one bit per pattern, so every instruction is a single
+    bitwise operation.
+
+    Args:
+        script: the springscript, with or without its final WALK or RUN
+
+    Returns:
+        the jump register as a mask with bit p set if pattern p jumps
+    """
+    registers = {"T": 0, "J": 0}
+    for line in script.splitlines():
+        parts = line.split()
+        if len(parts) != 3:
+            continue
+
+        operation, source, target = parts
+        value = registers[source] if source in registers else SENSOR_MASKS[source]
+        if operation == "AND":
+            registers[target] &= value
+        elif operation == "OR":
+            registers[target] |= value
+        elif operation == "NOT":
+            registers[target] = ~value & ALL_PATTERNS
+        else:
+            raise ValueError("Unknown instruction: " + line)
+
+    return registers["J"]
+
+
+class Hull(namedtuple("Hull", ["ground", "length"])):
+    """ A stretch of hull as a bit vector, with bit i set where there is ground.
+
+    The droid starts on the first cell, and anything after the end of the
+    stretch is treated as ground.
+    """
+
+    @staticmethod
+    def parse(line: str) -> "Hull":
+        """ Parse a line of hull such as "#####.#..########" """
+        ground = sum(1 << index for index, char in enumerate(line) if char != '.')
+        return Hull(ground, len(line))
+
+    def __str__(self):
+        return "".join('#' if self.ground >> index & 1 else '.'
+                       for index in range(self.length))
+
+    def pattern(self, position: int) -> int:
+        """ The sensor pattern seen from a position """
+        ground = self.ground | (ALL_PATTERNS << self.length)
+        return ground >> (position + 1) & (NUM_PATTERNS - 1)
+
+    def crossed_by(self, jumps: int) -> bool:
+        """ Whether the droid makes it across.
+
+        Args:
+            jumps: a mask with bit p set if the droid jumps on pattern p
+        """
+        position = 0
+        while position < self.length:
+            if not self.ground >> position & 1:
+                return False
+
+            position += 4 if jumps >> self.pattern(position) & 1 else 1
+
+        return True
+
+
+def parse_failure(text: str) -> Hull:
+    """ The hull on which the droid fell, from the output of a failed run.
+
+    The output ends with an animation of the droid's last moments, each
+    frame of which ends with the same stretch of hull, with the droid drawn
+    in the hole of the final frame.
+
+    Returns:
+        the hull, or None if the output does not show a fall
+    """
+    if "Didn't make it across" not in text:
+        return None
+
+    frames = text.split("Didn't make it across:")[-1].strip().split("\n\n")
+    line = frames[-1].strip().splitlines()[-1]
+    return Hull.parse(line.replace('@', '.'))
+
+
+class HullCorpus:
+    """ The hulls on which the droid has fallen, kept one per line in a file.
+
+    Args:
+        path: the corpus file, which is loaded if it exists [None]
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.hulls = []
+        if path is not None and os.path.exists(path):
+            with open(path) as file:
+                self.hulls = [Hull.parse(line.strip()) for line in file if line.strip()]
+
+    def __len__(self):
+        return len(self.hulls)
+
+    def __iter__(self):
+        return iter(self.hulls)
+
+    def add(self, hull: Hull) -> bool:
+        """ Add a hull, saving the corpus if it is new """
+        if hull in self.hulls:
+            return False
+
+        self.hulls.append(hull)
+        self.save()
+        return True
+
+    def save(self):
+        """ Write the corpus to its file, if it has one """
+        if self.path is None:
+            return
+
+        with open(self.path, "w") as file:
+            for hull in self.hulls:
+                file.write(str(hull) + "\n")
+
+    def failure(self, script: str) -> Hull:
+        """ The first hull in the corpus on which a script falls, or None """
+        jumps = evaluate(script)
+        for hull in self.hulls:
+            if not hull.crossed_by(jumps):
+                return hull
+
+        return None
+
+
+# Jumping with a hole at D, or walking with a hole at A, always falls, so
+# every script can end by jumping exactly when A is a hole and D is ground,
+# and the search only has to decide the patterns with ground at A and D
+SUFFIX = ["NOT A T", "OR T J", "AND D J"]
+DECIDED = SENSOR_MASKS["A"] & SENSOR_MASKS["D"]
+HOLE, WALK, JUMP = -1, -2, -3
+
+
+def _steps(hull, lookup):
+    steps = []
+    for position in range(hull.length):
+        pattern = hull.pattern(position)
+        if not hull.ground >> position & 1:
+            steps.append(HOLE)
+        elif pattern in lookup:
+            steps.append(lookup[pattern])
+        else:
+            steps.append(JUMP if pattern >> 3 & 1 else WALK)
+
+    return steps
+
+
+def _crosses(steps, jumps):
+    position = 0
+    length = len(steps)
+    while position < length:
+        step = steps[position]
+        if step == HOLE:
+            return False
+
+        if step == JUMP or (step >= 0 and jumps >> step & 1):
+            position += 4
+        else:
+            position += 1
+
+    return True
+
 
-    computer.print_ascii()
-    computer.write_ascii(assembler)
+def search(hulls, mode="WALK", max_instructions=MAX_INSTRUCTIONS):
+    """ Find a springscript which makes it across every hull.
 
-    while not computer.is_halted:
-        computer.step()
+    Searches breadth first over the values of the T and J registers, which
+    are tracked only for the undecided sensor patterns which the droid can
+    see while standing on the hulls, so scripts which compute the same
+    registers are explored once. The result is a shortest script ending
+    with `SUFFIX`.
 
-    return computer.print_ascii()
+    Args:
+        hulls: the hulls to cross
+
+    Keyword Args:
+        mode: "WALK" or "RUN" ["WALK"]
+        max_instructions: the maximum script length [15]
+
+    Returns:
+        a list of instructions, or None if there is no such script
+    """
+    patterns = sorted({hull.pattern(position)
+                       for hull in hulls
+                       for position in range(hull.length)
+                       if hull.ground >> position & 1 and DECIDED >> hull.pattern(position) & 1})
+    lookup = {pattern: index for index, pattern in enumerate(patterns)}
+    steps = [_steps(hull, lookup) for hull in hulls]
+    bits = len(patterns)
+    full = (1 << bits) - 1
+    sensors = MODES[mode]
+    names = list(sensors) + ["T", "J"]
+    values = [sum(1 << index for index, pattern in enumerate(patterns)
+                  if SENSOR_MASKS[sensor] >> pattern & 1)
+              for sensor in sensors]
+
+    def _goal(jumps):
+        return all(_crosses(hull_steps, jumps) for hull_steps in steps)
+
+    def _script(state, last=None):
+        script = [] if last is None else [last]
+        while parents[state] is not None:
+            state, instruction = parents[state]
+            script.append(instruction)
+
+        return script[::-1] + SUFFIX
+
+    parents = {0: None}
+    frontier = [0]
+    tested = {0}
+    if _goal(0):
+        return _script(0)
+
+    for depth in range(max_instructions - len(SUFFIX)):
+        last_layer = depth == max_instructions - len(SUFFIX) - 1
+        next_frontier = []
+        for state in frontier:
+            temp = state >> bits
+            jump = state & full
+            for name, value in zip(names, values + [temp, jump]):
+                for operation, current in (("AND", jump & value), ("OR", jump | value),
+                                           ("NOT", ~value & full)):
+                    new_state = temp << bits | current
+                    if new_state in parents:
+                        continue
+
+                    if current not in tested:
+                        tested.add(current)
+                        if _goal(current):
+                            return _script(state, "{} {} J".format(operation, name))
+
+                    if not last_layer:
+                        parents[new_state] = state, "{} {} J".format(operation, name)
+                        next_frontier.append(new_state)
+
+                if last_layer:
+                    continue
+
+                for operation, current in (("AND", temp & value), ("OR", temp | value),
+                                           ("NOT", ~value & full)):
+                    new_state = current << bits | jump
+                    if new_state not in parents:
+                        parents[new_state] = state, "{} {} T".format(operation, name)
+                        next_frontier.append(new_state)
+
+        frontier = next_frontier
+
+    return None
+
+
+def try_script(program, script: str, corpus: HullCorpus):
+    """ Test a springscript, against the corpus first and then for real.
+
+    The real program is only run if the script crosses every hull in the
+    corpus, and any hull it then falls on is added to the corpus.
+
+    Args:
+        program: the springdroid program
+        script: the springscript, ending with WALK or RUN
+        corpus: the hulls on which earlier scripts fell
+
+    Returns:
+        (result, hull) where result is the hull damage reported if the droid
+        makes it across, and hull is the one it fell on otherwise
+    """
+    hull = corpus.failure(script)
+    if hull is not None:
+        return None, hull
+
+    output = StringIO()
+    result = _run_assembler(program, script, output)
+    if result is not None:
+        return result, None
+
+    hull = parse_failure(output.getvalue())
+    if hull is None or not corpus.add(hull):
+        raise ValueError("Unable to learn from the failed run:\n" + output.getvalue())
+
+    return None, hull
+
+
+def find_script(program, mode="WALK", corpus=None, verbose=False):
+    """ Search for a springscript, learning hulls from the runs which fail.
+
+    Each candidate is the shortest script which crosses every hull in the
+    corpus. It is run on the real program, and if the droid falls then the
+    hull it fell on is added to the corpus.
+
+    Args:
+        program: the springdroid program
+
+    Keyword Args:
+        mode: "WALK" or "RUN" ["WALK"]
+        corpus: the hulls on which earlier scripts fell [HullCorpus()]
+        verbose: print each candidate and failure [False]
+
+    Returns:
+        (instructions, result), or None if no script crosses the hulls
+    """
+    if corpus is None:
+        corpus = HullCorpus()
+
+    while True:
+        script = search(corpus.hulls, mode)
+        if script is None:
+            return None
+
+        result, hull = try_script(program, "\n".join(script + [mode]), corpus)
+        if result is not None:
+            return script, result
+
+        if verbose:
+            print(" / ".join(script), "fell on", hull)
+
+
+def test_evaluate():
+    """ Test """
+    jumps = evaluate(ASSEMBLER0)
+    for pattern in range(NUM_PATTERNS):
+        sensors = [pattern >> index & 1 for index in range(4)]
+        expected = not all(sensors[:3]) and sensors[3]
+        assert (jumps >> pattern & 1) == expected
+
+
+def test_search():
+    """ Test """
+    hulls = [Hull.parse(line) for line in ("#####.###########",
+                                           "#####.#..########",
+                                           "#####...#########")]
+    script = search(hulls)
+    jumps = evaluate("\n".join(script))
+    assert all(hull.crossed_by(jumps) for hull in hulls)
+    assert not Hull.parse("#####.###########").crossed_by(0)
+    assert str(hulls[1]) == "#####.#..########"
+
+
+FAILURE = """Walking...
+
+
+Didn't make it across:
+
+.................
+.................
+@................
+#####.#..########
+
+.................
+.................
+.................
+#####@#..########
+
+"""
+
+
+def test_corpus(tmp_path):
+    """ Test """
+    hull = parse_failure(FAILURE)
+    assert hull == Hull.parse("#####.#..########")
+    assert parse_failure("Walking...\n") is None
+
+    path = str(tmp_path / "hulls.txt")
+    corpus = HullCorpus(path)
+    assert corpus.add(hull)
+    assert not corpus.add(hull)
+    assert corpus.failure("NOT A J\nWALK") == hull
+    assert corpus.failure(ASSEMBLER1) is None
+    assert list(HullCorpus(path)) == [hull]
 
 
 def _main():
@@ -45,6 +435,11 @@ def _main():
 
     print("Part 2:", _run_assembler(program, ASSEMBLER1))
 
+    corpus = HullCorpus()
+    for mode in MODES:
+        script, result = find_script(program, mode, corpus)
+        print(mode, "search:", result, "with", " / ".join(script))
+
 
 if __name__ == "__main__":
     _main()
@@ -1,116 +1,484 @@
 """ Solution to day 23 """
 
+import multiprocessing
 from collections import deque
 
+import pytest
+
 from intcode import Computer
 from common import asset, Vector
 
 
-class Network:
-    """ Represents a network of Intcode servers """
+class NodeStats:
+    """ Counters for a single server """
 
-    def __init__(self, program, num_servers=50):
-        self.num_servers = num_servers
-        self.computers = [Computer(program) for _ in range(num_servers)]
-        self.queues = [deque() for _ in range(num_servers)]
-        self.idle = [False]*num_servers
-        self.nat = None
-        self.reset()
+    __slots__ = ("packets_in", "packets_out", "instructions", "turns", "idle_turns")
 
-    def _start_server(self, index):
-        computer = self.computers[index]
-        computer.reset()
-        while not computer.needs_input:
-            computer.step()
-
-        computer.write(index)
-        computer.step()
-        self.queues[index].clear()
-
-    def _write_from_queue(self, index):
-        computer = self.computers[index]
-        queue = self.queues[index]
-        if queue:
-            while queue:
-                vec = queue.popleft()
-                computer.write(vec.x)
-                computer.write(vec.y)
-
-    def _wait_for_outputs(self, index):
-        computer = self.computers[index]
-        while not computer.num_outputs:
-            if computer.needs_input:
-                computer.write(-1)
-                return False
-
-            computer.step()
+    def __init__(self):
+        self.packets_in = 0
+        self.packets_out = 0
+        self.instructions = 0
+        self.turns = 0
+        self.idle_turns = 0
 
-        return True
+    def __repr__(self):
+        return "NodeStats({})".format(", ".join("{}={}".format(name, getattr(self, name))
+                                                for name in self.__slots__))
+
+
+class Scheduler:
+    """ Runs a network of Intcode servers from a ready queue.
+
+    Only servers with packets waiting, or which did something on their last
+    turn, are on the ready queue. Each turn runs a server until it blocks on
+    input, and delivering a packet puts its destination on the queue, so the
+    work done is proportional to the traffic. The network is idle when the
+    ready queue is empty.
+
+    Args:
+        program: the NIC program
+
+    Keyword Args:
+        num_servers: the number of servers, with addresses from 0 [50]
+        addresses: the addresses of the servers, instead of num_servers [None]
+        nat_address: packets sent here are kept as `nat` [255]
+        reserved: addresses which are always sent outbound, even if a server
+                  here has the same address [()]
+        batch_size: the most packets delivered to a server in a turn [None]
+
+    Attributes:
+        outbound: (address, packet) pairs sent to addresses not on this
+                  scheduler, waiting to be collected
+        stats: a `NodeStats` for each address
+    """
+
+    def __init__(self, program, num_servers=50, addresses=None, nat_address=255,
+                 reserved=(), batch_size=None):
+        if addresses is None:
+            addresses = range(num_servers)
 
-    def _write_output(self, index):
-        computer = self.computers[index]
-        while computer.num_outputs < 3:
-            computer.step()
-
-        if computer.num_outputs == 3:
-            address = computer.read()
-            x = computer.read()
-            y = computer.read()
-            packet = Vector(x, y)
-            if address == 255:
-                self.nat = packet
-            else:
-                self.queues[address].append(packet)
+        self.addresses = list(addresses)
+        self.num_servers = len(self.addresses)
+        self.computers = {address: Computer(program) for address in self.addresses}
+        self.queues = {address: deque() for address in self.addresses}
+        self.stats = {}
+        self.outbound = []
+        self.ready = deque()
+        self._scheduled = set()
+        self._nat_address = nat_address
+        self._reserved = frozenset(reserved)
+        self._batch_size = batch_size
+        self.nat = None
+        self.num_turns = 0
+        self.reset()
 
     def reset(self):
         """ Reset the state of the network """
         self.nat = None
-        for i in range(self.num_servers):
-            self._start_server(i)
+        self.num_turns = 0
+        self.outbound.clear()
+        self.ready.clear()
+        self._scheduled.clear()
+        for address, computer in self.computers.items():
+            computer.reset()
+            computer.write(address)
+            self.queues[address].clear()
+            self.stats[address] = NodeStats()
+            self._schedule(address)
+
+    def _schedule(self, address):
+        if address not in self._scheduled:
+            self._scheduled.add(address)
+            self.ready.append(address)
+
+    def send(self, address, packet):
+        """ Deliver a packet, waking its destination if it was idle """
+        if address == self._nat_address:
+            self.nat = packet
+        elif address in self._reserved or address not in self.queues:
+            self.outbound.append((address, packet))
+        else:
+            self.queues[address].append(packet)
+            self._schedule(address)
+
+    def _turn(self, address):
+        computer = self.computers[address]
+        queue = self.queues[address]
+        stats = self.stats[address]
+        received = len(queue)
+        if self._batch_size is not None:
+            received = min(received, self._batch_size)
+
+        if received:
+            for _ in range(received):
+                computer.write_all(queue.popleft())
+        else:
+            computer.write(-1)
+
+        ticks = computer.instruction_count
+        computer.run_until_blocked()
+        outputs = computer.read_all()
+        for i in range(0, len(outputs), 3):
+            self.send(outputs[i], Vector(outputs[i + 1], outputs[i + 2]))
+
+        stats.packets_in += received
+        stats.packets_out += len(outputs) // 3
+        stats.instructions += computer.instruction_count - ticks
+        stats.turns += 1
+        if not (received or outputs):
+            stats.idle_turns += 1
+
+        self.num_turns += 1
+        return received or outputs or queue
+
+    def step(self) -> bool:
+        """ Give one server a turn.
+
+        Returns:
+            False if the network is idle
+        """
+        if not self.ready:
+            return False
+
+        address = self.ready.popleft()
+        self._scheduled.remove(address)
+        if self._turn(address):
+            self._schedule(address)
+
+        return True
+
+    def run(self, max_turns: int = None):
+        """ Give servers turns until the network is idle.
+
+        Keyword Args:
+            max_turns: stop after this many turns [None]
+
+        Returns:
+            the outbound packets, which are removed from `outbound`
+        """
+        turns = 0
+        while (max_turns is None or turns < max_turns) and self.step():
+            turns += 1
+
+        outbound = self.outbound
+        self.outbound = []
+        return outbound
 
     def part1(self):
         """ Run the network until the NAT is assigned """
         while self.nat is None:
-            for i in range(self.num_servers):
-                if self.nat is not None:
-                    break
-
-                self._write_from_queue(i)
-                if self._wait_for_outputs(i):
-                    self._write_output(i)
+            if not self.step():
+                raise ValueError("The network went idle before reaching the NAT")
 
         return self.nat.y
 
     def part2(self):
-        """ Run the network until the same NAT y value is sent twice """
+        """ Run the network until the same NAT y value is sent twice in a row """
         last_y = None
-        idle_count = 0
         while True:
-            for i in range(self.num_servers):
-                self._write_from_queue(i)
-                if self._wait_for_outputs(i):
-                    self._write_output(i)
-                    self.idle[i] = False
-                else:
-                    self.idle[i] = True
-
-            if all(self.idle):
-                idle_count += 1
-                if idle_count > 1:
-                    self.queues[0].append(self.nat)
-                    if self.nat.y == last_y:
-                        return last_y
-
-                    last_y = self.nat.y
-            else:
-                idle_count = 0
+            if self.step():
+                continue
+
+            if self.nat is None:
+                raise ValueError("The network went idle before reaching the NAT")
+
+            self.send(0, self.nat)
+            if self.nat.y == last_y:
+                return last_y
+
+            last_y = self.nat.y
+
+
+class Nat:
+    """ Keeps the last packet sent to it, and sends it on when the network is idle.
+
+    Args:
+        address: the address of the NAT [255]
+        target: the address to which packets are sent when idle [0]
+    """
+
+    def __init__(self, address=255, target=0):
+        self.address = address
+        self.target = target
+        self.first = None
+        self.packet = None
+        self.sent = []
+
+    def receive(self, packet):
+        """ Keep a packet """
+        if self.first is None:
+            self.first = packet
+
+        self.packet = packet
+
+    @property
+    def repeated(self) -> bool:
+        """ Whether the last two packets sent had the same y value """
+        return len(self.sent) > 1 and self.sent[-1].y == self.sent[-2].y
+
+
+def _shard_worker(program, addresses, reserved, batch_size, inbox, outbox):
+    shard = Scheduler(program, addresses=addresses, nat_address=None, reserved=reserved,
+                      batch_size=batch_size)
+    while True:
+        message = inbox.get()
+        if message is None:
+            return
+
+        kind, payload = message
+        if kind == "run":
+            packets, max_turns = payload
+            for address, packet in packets:
+                shard.send(address, packet)
+
+            outbound = shard.run(max_turns)
+            outbox.put((outbound, not shard.ready))
+        elif kind == "stats":
+            outbox.put(shard.stats)
+
+
+class Simulator:
+    """ A network of Intcode servers with configurable routing.
+
+    The servers are split into shards of consecutive addresses, each run by
+    a `Scheduler`, either in this process or in a worker process of its own.
+    The network runs in rounds: each shard runs until it is idle, or for
+    `round_turns` turns, and the packets sent between shards, to groups or to
+    NATs are then routed in batches. When every shard is idle and no packets
+    are in flight, each NAT sends on the last packet it received.
+
+    Args:
+        program: the NIC program
+        num_servers: the number of servers, with addresses from 0
+
+    Keyword Args:
+        nats: the NATs, whose addresses must not be server addresses
+              [a single `Nat()`]
+        groups: broadcast addresses, which must not be server addresses,
+                each mapped to the addresses which receive its packets [None]
+        processes: the number of shards, each in a worker process, or 1 to
+                   run a single shard in this process [1]
+        batch_size: the most packets delivered to a server in a turn [None]
+        round_turns: the most turns each shard runs in a round [None]
+
+    Attributes:
+        dropped: the number of packets sent to unknown addresses
+        num_rounds: the number of rounds run
+    """
+
+    def __init__(self, program, num_servers, nats=None, groups=None, processes=1,
+                 batch_size=None, round_turns=None):
+        self.num_servers = num_servers
+        self.nats = {nat.address: nat for nat in (nats or [Nat()])}
+        self.groups = dict(groups or {})
+        reserved = set(self.nats) | set(self.groups)
+        clashes = sorted(address for address in reserved if 0 <= address < num_servers)
+        if clashes:
+            raise ValueError("NAT and group addresses are also server addresses: {}"
+                             .format(clashes))
+
+        self.dropped = 0
+        self.num_rounds = 0
+        self._round_turns = round_turns
+        self._shard_size = -(-num_servers // processes)
+        shards = [range(start, min(start + self._shard_size, num_servers))
+                  for start in range(0, num_servers, self._shard_size)]
+        self._pending = [[] for _ in shards]
+        self._idle = [False] * len(shards)
+        self._workers = []
+        self._local = None
+        if processes == 1:
+            self._local = Scheduler(program, addresses=shards[0], nat_address=None,
+                                    reserved=reserved, batch_size=batch_size)
+            return
+
+        self._outboxes = []
+        for addresses in shards:
+            inbox = multiprocessing.Queue()
+            outbox = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_shard_worker,
+                                             args=(program, addresses, reserved,
+                                                   batch_size, inbox, outbox),
+                                             daemon=True)
+            worker.start()
+            self._workers.append((worker, inbox))
+            self._outboxes.append(outbox)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Stop any worker processes """
+        for worker, inbox in self._workers:
+            inbox.put(None)
+            worker.join()
+
+        self._workers = []
+
+    def send(self, address, packet):
+        """ Send a packet into the network from outside """
+        self._route(address, packet)
+
+    def _route(self, address, packet):
+        if address in self.nats:
+            self.nats[address].receive(packet)
+        elif address in self.groups:
+            for member in self.groups[address]:
+                self._route(member, packet)
+        elif 0 <= address < self.num_servers:
+            self._pending[address // self._shard_size].append((address, packet))
+        else:
+            self.dropped += 1
+
+    def _round(self):
+        if self._local is not None:
+            for address, packet in self._pending[0]:
+                self._local.send(address, packet)
+
+            results = [(self._local.run(self._round_turns), not self._local.ready)]
+        else:
+            for (_, inbox), packets in zip(self._workers, self._pending):
+                inbox.put(("run", (packets, self._round_turns)))
+
+            results = [outbox.get() for outbox in self._outboxes]
+
+        self._pending = [[] for _ in self._pending]
+        for index, (outbound, idle) in enumerate(results):
+            self._idle[index] = idle
+            for address, packet in outbound:
+                self._route(address, packet)
+
+        self.num_rounds += 1
+
+    def _wake(self) -> bool:
+        woken = False
+        for nat in self.nats.values():
+            if nat.packet is not None:
+                nat.sent.append(nat.packet)
+                self._route(nat.target, nat.packet)
+                woken = True
+
+        return woken
+
+    def run(self, until, max_rounds: int = None) -> bool:
+        """ Run the network until a condition holds.
+
+        Args:
+            until: function (simulator) -> whether to stop, checked after
+                   every round and every time the NATs send
+
+        Keyword Args:
+            max_rounds: give up after this many rounds [None]
+
+        Returns:
+            whether the condition was met
+        """
+        rounds = 0
+        while max_rounds is None or rounds < max_rounds:
+            self._round()
+            rounds += 1
+            if until(self):
+                return True
+
+            if all(self._idle) and not any(self._pending):
+                if not self._wake():
+                    return False
+
+                if until(self):
+                    return True
+
+        return False
+
+    def stats(self):
+        """ The `NodeStats` of every server, by address """
+        if self._local is not None:
+            return dict(self._local.stats)
+
+        result = {}
+        for (_, inbox), outbox in zip(self._workers, self._outboxes):
+            inbox.put(("stats", None))
+            result.update(outbox.get())
+
+        return result
+
+
+def _relay(num_servers, nat_address=255):
+    """ A NIC which passes (x, y) on to the next address as (x, y - 1),
+    sending (x, x) to the NAT instead once y reaches zero """
+    return [3, 100, 3, 101, 108, -1, 101, 103, 1005, 103, 2, 3, 102,
+            1008, 102, 0, 103, 1005, 103, 48, 101, 1, 100, 103,
+            1007, 103, num_servers, 104, 1005, 104, 35, 1101, 0, 0, 103,
+            4, 103, 4, 101, 101, -1, 102, 102, 4, 102, 1105, 1, 2,
+            104, nat_address, 4, 101, 4, 101, 1105, 1, 2]
+
+
+def test_scheduler():
+    """ Test """
+    network = Scheduler(_relay(20), 20)
+    with pytest.raises(ValueError):
+        network.part2()
+
+    network.reset()
+    network.send(5, Vector(3, 2))
+    assert network.part1() == 3
+    assert network.stats[7].packets_out == 1
+    assert network.part2() == 3
+    assert network.stats[0].packets_in == 1
+    assert len(network.queues[0]) == 1
+
+    network.reset()
+    with pytest.raises(ValueError):
+        network.part1()
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_simulator(processes):
+    """ Test """
+    with Simulator(_relay(200), 200, groups={1000: [10, 190]},
+                   processes=processes) as simulator:
+        nat = simulator.nats[255]
+        simulator.send(1000, Vector(3, 0))
+        simulator.send(5000, Vector(3, 0))
+        assert simulator.run(lambda sim: nat.first is not None)
+        assert nat.first == Vector(3, 3)
+        assert simulator.dropped == 1
+        assert simulator.run(lambda sim: nat.repeated)
+        assert nat.sent == [Vector(3, 3)] * 2
+
+        stats = simulator.stats()
+        assert len(stats) == 200
+        assert sum(node.packets_in for node in stats.values()) == 2 + 4
+        assert stats[190].packets_out == 1
+        assert all(node.idle_turns >= 1 for node in stats.values())
+
+
+def test_simulator_large():
+    """ Test a network with more servers than the default NAT address """
+    with pytest.raises(ValueError):
+        Simulator(_relay(300), 300)
+
+    with pytest.raises(ValueError):
+        Simulator(_relay(300, -2), 300, nats=[Nat(-2)], groups={100: [1, 2]})
+
+    with Simulator(_relay(300, -2), 300, nats=[Nat(-2)], groups={-1: [250, 10]},
+                   processes=2) as simulator:
+        nat = simulator.nats[-2]
+        simulator.send(-1, Vector(5, 20))
+        assert simulator.run(lambda sim: nat.first is not None, max_rounds=10)
+        assert nat.first == Vector(5, 5)
+        stats = simulator.stats()
+        assert stats[255].packets_in == 1
+        assert sum(node.packets_in for node in stats.values()) == 2 * 21
 
 
 def _main():
     with open(asset("day23.txt")) as file:
         program = [int(part) for part in file.read().split(',')]
 
-    network = Network(program)
+    network = Scheduler(program)
     print("Part 1:", network.part1())
 
     network.reset()
@@ -1,47 +1,258 @@
 """ Solution to Day 25 """
 
+import re
+from collections import deque, namedtuple
+
 from common import asset
 from intcode import Computer
+from ascii_channel import AsciiChannel
+
+OPPOSITE = {
+    "north": "south",
+    "south": "north",
+    "east": "west",
+    "west": "east"
+}
+
+MAX_CHARS = 20000
+
+
+class Room(namedtuple("Room", ["name", "description", "doors", "items"])):
+    """ A room on the ship """
+
+    @staticmethod
+    def parse(text: str) -> "Room":
+        """ Parse the last room described in some output.
+
+        Returns:
+            the room, or None if the output does not describe one
+        """
+        start = text.rfind("\n== ")
+        if start < 0:
+            return None
+
+        lines = text[start:].strip().splitlines()
+        name = lines[0].strip("= ")
+        description = lines[1] if len(lines) > 1 else ""
+        lists = {}
+        heading = None
+        for line in lines[2:]:
+            if line.endswith(":"):
+                heading = line
+                lists[heading] = []
+            elif line.startswith("- ") and heading is not None:
+                lists[heading].append(line[2:])
+            else:
+                heading = None
+
+        return Room(name, description, lists.get("Doors here lead:", []),
+                    lists.get("Items here:", []))
+
+
+def _send(channel: AsciiChannel, command: str):
+    """ Send a command, and report whether the program is still taking commands.
+
+    Returns:
+        (text, status) where status is "ok", "halted" if the program stopped,
+        or "loop" if it kept running without asking for the next command
+    """
+    channel.send_lines(command)
+    text = channel.read_text(MAX_CHARS)
+    if channel.computer.is_halted:
+        return text, "halted"
+
+    if not channel.computer.needs_input:
+        return text, "loop"
+
+    return text, "ok"
+
+
+def _is_ejected(text):
+    return "Alert!" in text
+
+
+class Explorer:
+    """ Maps the ship, collects the safe items and gets past the checkpoint.
+
+    Exploration is breadth first, with a fork of the computer standing in
+    each room, so the droid never has to walk back. Each item is tried out
+    on a fork before it is taken for real, and any which halts the program,
+    hangs it, or stops the droid from moving is blacklisted.
+
+    Args:
+        program: the droid program
+
+    Attributes:
+        rooms: each room found, by name
+        links: the room reached through each (room name, door)
+        safe_items: the room of each item which can be carried
+        blacklist: the items which cannot
+        checkpoint: the room with the door to the pressure-sensitive floor
+        floor_door: the door to the pressure-sensitive floor
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self.rooms = {}
+        self.links = {}
+        self.safe_items = {}
+        self.blacklist = set()
+        self.start = None
+        self.checkpoint = None
+        self.floor_door = None
+
+    def _is_safe(self, channel, room, item):
+        fork = AsciiChannel(channel.computer.fork())
+        _, status = _send(fork, "take " + item)
+        if status != "ok":
+            return False
+
+        text, status = _send(fork, room.doors[0])
+        return status == "ok" and (Room.parse(text) is not None or _is_ejected(text))
+
+    def explore(self):
+        """ Map every room reachable from the start """
+        channel = AsciiChannel(Computer(self.program))
+        room = Room.parse(channel.read_text(MAX_CHARS))
+        self.start = room.name
+        self.rooms[room.name] = room
+        queue = deque([(room, channel)])
+        while queue:
+            room, channel = queue.popleft()
+            for item in room.items:
+                if self._is_safe(channel, room, item):
+                    self.safe_items[item] = room.name
+                else:
+                    self.blacklist.add(item)
+
+            for door in room.doors:
+                fork = AsciiChannel(channel.computer.fork())
+                text, status = _send(fork, door)
+                if status != "ok":
+                    continue
+
+                if _is_ejected(text):
+                    self.checkpoint = room.name
+                    self.floor_door = door
+                    continue
+
+                next_room = Room.parse(text)
+                self.links[room.name, door] = next_room.name
+                if next_room.name not in self.rooms:
+                    self.rooms[next_room.name] = next_room
+                    queue.append((next_room, fork))
+
+    def route(self, start: str, goal: str):
+        """ The shortest list of doors from one room to another """
+        paths = {start: []}
+        queue = deque([start])
+        while queue:
+            name = queue.popleft()
+            if name == goal:
+                return paths[name]
+
+            for door in self.rooms[name].doors:
+                next_name = self.links.get((name, door))
+                if next_name is not None and next_name not in paths:
+                    paths[next_name] = paths[name] + [door]
+                    queue.append(next_name)
+
+        return None
+
+    def collect(self):
+        """ The commands which pick up every safe item and go to the checkpoint """
+        commands = []
+        current = self.start
+        for item, name in self.safe_items.items():
+            commands += self.route(current, name) + ["take " + item]
+            current = name
+
+        return commands + self.route(current, self.checkpoint)
+
+    def solve(self) -> int:
+        """ Explore the ship and find the combination of items which passes
+        the pressure-sensitive floor.
+
+        Subsets of the items are tried in Gray code order, so that each one
+        differs from the last by a single item. A subset which is too heavy
+        rules out every subset containing it, and one which is too light
+        every subset it contains.
+
+        Returns:
+            the airlock password
+        """
+        self.explore()
+        channel = AsciiChannel(Computer(self.program))
+        channel.read_text(MAX_CHARS)
+        channel.send_lines(self.collect())
+        channel.read_text(MAX_CHARS)
+
+        items = list(self.safe_items)
+        full = (1 << len(items)) - 1
+        too_heavy = []
+        too_light = []
+        held = full
+        for index in range(1 << len(items)):
+            target = full ^ (index ^ (index >> 1))
+            changed = held ^ target
+            if changed:
+                bit = changed.bit_length() - 1
+                action = "take " if target >> bit & 1 else "drop "
+                _send(channel, action + items[bit])
+                held = target
+
+            if any(held & heavy == heavy for heavy in too_heavy):
+                continue
+
+            if any(held | light == light for light in too_light):
+                continue
+
+            text, _ = _send(channel, self.floor_door)
+            if "lighter than" in text:
+                too_heavy.append(held)
+            elif "heavier than" in text:
+                too_light.append(held)
+            else:
+                match = re.search(r"typing (\d+)", text)
+                if match:
+                    return int(match.group(1))
+
+        return None
+
+
+ROOM = """
+== Hull Breach ==
+You got in through a hole in the floor here.
+
+Doors here lead:
+- east
+- south
+
+Items here:
+- mouse
+
+Command?
+"""
+
+
+def test_room():
+    """ Test """
+    room = Room.parse("\n\n" + ROOM)
+    assert room.name == "Hull Breach"
+    assert room.description == "You got in through a hole in the floor here."
+    assert room.doors == ["east", "south"]
+    assert room.items == ["mouse"]
+    assert Room.parse("\nYou take the mouse.\n\nCommand?\n") is None
 
 
 def _main():
     with open(asset("day25.txt")) as file:
         program = [int(part) for part in file.read().split(',')]
 
-    computer = Computer(program)
-    commands = [
-        "south",
-        "take mouse",
-        "north",
-        "west",
-        "north",
-        "north",
-        "north",
-        "west",
-        "take semiconductor",
-        "east",
-        "south",
-        "west",
-        "south",
-        "take hypercube",
-        "north",
-        "east",
-        "south",
-        "west",
-        "take antenna",
-        "west",
-        "south",
-        "south",
-        "south"
-    ]
-
-    computer.write_ascii("\n".join(commands) + '\n')
-    while not computer.is_halted:
-        while not computer.num_outputs and not computer.is_halted:
-            computer.step()
-
-        if computer.num_outputs:
-            computer.print_ascii()
+    explorer = Explorer(program)
+    print("Part 1:", explorer.solve())
+    print("Items:", ", ".join(sorted(explorer.safe_items)))
+    print("Blacklist:", ", ".join(sorted(explorer.blacklist)))
 
 
 if __name__ == "__main__":
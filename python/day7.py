@@ -1,36 +1,92 @@
 """ Solution to Day 7 """
 
+import heapq
 import itertools
+import multiprocessing
+from collections import deque
 
 import pytest
 
-from intcode import Computer
+from intcode import Computer, StopReason
 from common import asset
 
 
+class Pipeline:
+    """ A network of amplifiers connected by queues.
+
+    Each amplifier runs until it blocks on input or produces an output,
+    which is then queued for every stage it feeds. Only stages with work
+    to do are scheduled, and the network runs until every stage is halted
+    or starved of input.
+
+    Args:
+        program: the amplifier program
+        settings: the phase setting of each stage
+
+    Keyword Args:
+        edges: (source, destination) stage pairs [a ring in stage order]
+    """
+
+    def __init__(self, program, settings, edges=None):
+        num_stages = len(settings)
+        if edges is None:
+            edges = [(i, (i + 1) % num_stages) for i in range(num_stages)]
+
+        self.stages = [Computer(program) for _ in settings]
+        self.queues = [deque([setting]) for setting in settings]
+        self.last_outputs = [None] * num_stages
+        self._targets = [[] for _ in settings]
+        for source, destination in edges:
+            self._targets[source].append(destination)
+
+    @property
+    def instruction_counts(self):
+        """ The number of instructions each stage has executed """
+        return [stage.instruction_count for stage in self.stages]
+
+    def run(self, inputs=None):
+        """ Run the network until no stage can make progress.
+
+        Keyword Args:
+            inputs: initial values to queue, keyed by stage [{0: [0]}]
+
+        Returns:
+            the last output produced by each stage
+        """
+        if inputs is None:
+            inputs = {0: [0]}
+
+        for index, values in inputs.items():
+            self.queues[index].extend(values)
+
+        ready = deque(range(len(self.stages)))
+        scheduled = set(ready)
+        while ready:
+            index = ready.popleft()
+            scheduled.remove(index)
+            stage = self.stages[index]
+            queue = self.queues[index]
+            stage.write_all(queue)
+            queue.clear()
+            stop = stage.run_until_blocked(max_outputs=1)
+            if stop.reason != StopReason.Output:
+                continue
+
+            value = stage.read()
+            self.last_outputs[index] = value
+            for target in self._targets[index]:
+                self.queues[target].append(value)
+
+            for target in self._targets[index] + [index]:
+                if target not in scheduled:
+                    ready.append(target)
+                    scheduled.add(target)
+
+        return self.last_outputs
+
+
 def _feedback(program, settings):
-    computers = [Computer(program) for _ in settings]
-
-    for computer, setting in zip(computers, settings):
-        computer.write(setting)
-
-    value = 0
-    computers[0].write(0)
-    all_halted = False
-    while not all_halted:
-        all_halted = True
-        for i, computer in enumerate(computers):
-            if not (computer.needs_input or computer.is_halted):
-                all_halted = False
-                computer.step()
-                if computer.num_outputs:
-                    if i + 1 < len(computers):
-                        computers[i+1].write(computer.read())
-                    else:
-                        value = computer.read()
-                        computers[0].write(value)
-
-    return value
+    return Pipeline(program, settings).run()[-1]
 
 
 @pytest.mark.parametrize("program, settings, expected", [
@@ -46,33 +102,180 @@ def test_feedback(program, settings, expected):
     assert _feedback(program, settings) == expected
 
 
-def _part1(program, verbose=False):
-    max_value = 0
-    for settings in itertools.permutations([0, 1, 2, 3, 4]):
-        value = 0
-        for setting in settings:
-            computer = Computer(program)
-            computer.run(inputs=[setting, value])
-            value = computer.read()
+def test_pipeline_topology():
+    """ Test a pipeline which fans one amplifier out to two others """
+    program = [3, 15, 3, 16, 1002, 16, 10, 16, 1, 16, 15, 15, 4, 15, 99, 0, 0]
+    pipeline = Pipeline(program, [1, 2, 3], edges=[(0, 1), (0, 2)])
+    assert pipeline.run({0: [4]}) == [41, 412, 413]
+    assert all(count > 0 for count in pipeline.instruction_counts)
+
+
+class _Amplifier:
+    """ Memoizes amplifier outputs, which depend only on (phase, signal) """
+
+    def __init__(self, program):
+        self._computer = Computer(program)
+        self._cache = {}
+        self.executions = 0
+
+    def __call__(self, phase, signal):
+        key = (phase, signal)
+        if key not in self._cache:
+            self._computer.reset()
+            self._computer.write_all(key)
+            self._computer.run_until_blocked(max_outputs=1)
+            self._cache[key] = self._computer.read()
+            self.executions += 1
+
+        return self._cache[key]
+
+
+def _search(program, phases, num_amplifiers=None, verbose=False):
+    """ Find the phase settings which produce the largest thruster signal.
+
+    Walks the tree of phase permutations depth first, so siblings share
+    the amplifier outputs of their common prefix, and memoizes each stage
+    by (phase, signal) so repeated pairs are never re-run.
+
+    Args:
+        program: the amplifier program
+        phases: the available phase settings, each used at most once
+
+    Keyword Args:
+        num_amplifiers: the length of the amplifier chain [len(phases)]
+        verbose: whether to print each new maximum [False]
+
+    Returns:
+        (max_value, settings, executions)
+    """
+    if num_amplifiers is None:
+        num_amplifiers = len(phases)
+
+    amplifier = _Amplifier(program)
+    best = [None, None]
+    settings = []
 
-        if value > max_value:
-            if verbose:
-                print("new max:", settings, value)
+    def _visit(signal, remaining):
+        if len(settings) == num_amplifiers:
+            if best[0] is None or signal > best[0]:
+                if verbose:
+                    print("new max:", tuple(settings), signal)
 
-            max_value = value
+                best[:] = [signal, tuple(settings)]
+
+            return
+
+        for i, phase in enumerate(remaining):
+            settings.append(phase)
+            _visit(amplifier(phase, signal), remaining[:i] + remaining[i+1:])
+            settings.pop()
+
+    _visit(0, list(phases))
+    return best[0], best[1], amplifier.executions
+
+
+@pytest.mark.parametrize("program, expected_value, expected_settings", [
+    ([3, 15, 3, 16, 1002, 16, 10, 16, 1, 16, 15, 15, 4, 15, 99, 0, 0],
+     43210, (4, 3, 2, 1, 0)),
+    ([3, 23, 3, 24, 1002, 24, 10, 24, 1002, 23, -1, 23, 101,
+      5, 23, 23, 1, 24, 23, 23, 4, 23, 99, 0, 0],
+     54321, (0, 1, 2, 3, 4)),
+    ([3, 31, 3, 32, 1002, 32, 10, 32, 1001, 31, -2, 31, 1007, 31, 0, 33,
+      1002, 33, 7, 33, 1, 33, 31, 31, 1, 32, 31, 31, 4, 31, 99, 0, 0, 0],
+     65210, (1, 0, 4, 3, 2))
+])
+def test_search(program, expected_value, expected_settings):
+    """ Test the amplifier chain search """
+    value, settings, executions = _search(program, [0, 1, 2, 3, 4])
+    assert value == expected_value
+    assert settings == expected_settings
+    assert executions < 5 * 120
+
+
+def _part1(program, verbose=False):
+    max_value, _, _ = _search(program, [0, 1, 2, 3, 4], verbose=verbose)
 
     print("Part 1:", max_value)
 
 
-def _part2(program, verbose=False):
-    max_value = 0
-    for settings in itertools.permutations([5, 6, 7, 8, 9]):
-        value = _feedback(program, settings)
-        if value > max_value:
-            if verbose:
-                print("new max:", settings, value)
+_WORKER_PROGRAM = None
+
+
+def _init_worker(program):
+    global _WORKER_PROGRAM
+    _WORKER_PROGRAM = program
+
+
+def _evaluate_feedback(chunk):
+    return [(settings, _feedback(_WORKER_PROGRAM, settings)) for settings in chunk]
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def sweep(program, phases, num_amplifiers=None, processes=None, chunk_size=32):
+    """ Evaluate every feedback loop permutation across worker processes.
+
+    Each worker receives the program once, when it starts, and then
+    evaluates chunks of permutations. Results are streamed back in the
+    order in which they complete.
+
+    Args:
+        program: the amplifier program
+        phases: the available phase settings
+
+    Keyword Args:
+        num_amplifiers: the number of amplifiers in the loop [len(phases)]
+        processes: the number of worker processes [os.cpu_count()]
+        chunk_size: permutations sent to a worker at a time [32]
+
+    Yields:
+        (settings, value) pairs
+    """
+    permutations = itertools.permutations(phases, num_amplifiers)
+    with multiprocessing.Pool(processes, _init_worker, (program,)) as pool:
+        for results in pool.imap_unordered(_evaluate_feedback,
+                                           _chunks(permutations, chunk_size)):
+            yield from results
+
+
+def _best_settings(results, top_k=1, verbose=False):
+    best = []
+    for settings, value in results:
+        if len(best) < top_k:
+            heapq.heappush(best, (value, settings))
+        elif value > best[0][0]:
+            heapq.heapreplace(best, (value, settings))
+        else:
+            continue
+
+        if verbose and value == max(best)[0]:
+            print("new max:", settings, value)
+
+    return sorted(best, reverse=True)
+
+
+def test_sweep():
+    """ Test the parallel feedback sweep """
+    program = [3, 26, 1001, 26, -4, 26, 3, 27, 1002, 27, 2, 27, 1, 27, 26,
+               27, 4, 27, 1001, 28, -1, 28, 1005, 28, 6, 99, 0, 0, 5]
+    results = sweep(program, [5, 6, 7, 8, 9], processes=2)
+    best = _best_settings(results, top_k=3)
+    assert len(best) == 3
+    assert best[0] == (139629729, (9, 8, 7, 6, 5))
+    assert best[1][0] <= best[0][0] and best[2][0] <= best[1][0]
+
 
-            max_value = value
+def _part2(program, verbose=False, processes=None):
+    results = sweep(program, [5, 6, 7, 8, 9], processes=processes)
+    (max_value, _), = _best_settings(results, verbose=verbose)
 
     print("Part 2:", max_value)
 
@@ -2,18 +2,30 @@
 
 import sys
 from enum import IntEnum
-from typing import List, Mapping
+from typing import List, Mapping, Tuple
 from collections import namedtuple
 
 import numpy as np
 import pytest
 
 
+PAGE_BITS = 6
+PAGE_SIZE = 1 << PAGE_BITS
+
+
 class Memory:
-    """ Class representing the memory of an Intcode computer """
+    """ Class representing the memory of an Intcode computer.
+
+    Writes are tracked at page granularity against any open markers: the
+    first write to a page after a marker is taken saves a copy of that page,
+    so diffing or restoring costs time proportional to the pages touched
+    rather than to the size of the memory.
+    """
 
     def __init__(self, values):
         self._lookup = dict(enumerate(values))
+        self._markers = {}
+        self._next_marker = 0
 
     def __getitem__(self, key):
         if isinstance(key, slice):
@@ -22,16 +34,103 @@ class Memory:
             step = 1 if key.step is None else key.step
             return [self[i] for i in range(start, stop, step)]
 
-        if key not in self._lookup:
-            self._lookup[key] = 0
-
-        return self._lookup[key]
+        return self._lookup.get(key, 0)
 
     def __setitem__(self, key, value):
+        if self._markers:
+            page = key >> PAGE_BITS
+            for saved in self._markers.values():
+                if page not in saved:
+                    saved[page] = self._page(page)
+
         self._lookup[key] = value
 
+    def _page(self, page):
+        start = page << PAGE_BITS
+        lookup = self._lookup
+        return {address: lookup[address]
+                for address in range(start, start + PAGE_SIZE)
+                if address in lookup}
+
+    def mark(self) -> int:
+        """ Start tracking writes from the current state.
+
+        Returns:
+            a marker which can be passed to `changes`, `restore` and `release`
+        """
+        marker = self._next_marker
+        self._next_marker += 1
+        self._markers[marker] = {}
+        return marker
+
+    def release(self, marker: int):
+        """ Stop tracking writes for a marker """
+        del self._markers[marker]
+
+    def dirty_pages(self, marker: int) -> List[int]:
+        """ The pages which have been written since the marker """
+        return sorted(self._markers[marker])
+
+    def changes(self, marker: int) -> List[Tuple[int, int, int]]:
+        """ The memory cells which have changed since the marker.
+
+        Returns:
+            a sorted list of (address, old, new) triples
+        """
+        lookup = self._lookup
+        result = []
+        for page in sorted(self._markers[marker]):
+            saved = self._markers[marker][page]
+            start = page << PAGE_BITS
+            for address in range(start, start + PAGE_SIZE):
+                old = saved.get(address, 0)
+                new = lookup.get(address, 0)
+                if old != new:
+                    result.append((address, old, new))
+
+        return result
+
+    def restore(self, marker: int):
+        """ Roll memory back to the state it was in when the marker was taken.
+
+        The marker remains open, tracking writes from the restored state.
+        """
+        saved_pages = self._markers[marker]
+        lookup = self._lookup
+        for page, saved in saved_pages.items():
+            start = page << PAGE_BITS
+            for address in range(start, start + PAGE_SIZE):
+                if address in saved:
+                    value = saved[address]
+                    if lookup.get(address) != value:
+                        self[address] = value
+                elif address in lookup:
+                    self._remove(address)
+
+        saved_pages.clear()
+
+    def _remove(self, address):
+        page = address >> PAGE_BITS
+        for saved in self._markers.values():
+            if page not in saved:
+                saved[page] = self._page(page)
+
+        del self._lookup[address]
+
+    def copy(self) -> "Memory":
+        """ An independent copy of the memory, including its open markers """
+        other = Memory([])
+        other._lookup = self._lookup.copy()
+        other._markers = {marker: {page: saved.copy() for page, saved in pages.items()}
+                          for marker, pages in self._markers.items()}
+        other._next_marker = self._next_marker
+        return other
+
     def to_list(self) -> List[int]:
         """ Converts the memory to a list representation """
+        if not self._lookup:
+            return []
+
         start = 0
         stop = max(self._lookup.keys()) + 1
         return [self[i] for i in range(start, stop)]
@@ -95,19 +194,93 @@ class Operation(namedtuple("Operation", ["code", "call", "num_params", "num_outp
         return self.call(params, memory, counter)
 
 
+class Coverage:
+    """ Bitmap of the addresses at which a program executed instructions.
+
+    Args:
+        size: the initial number of addresses covered by the bitmap [0]
+    """
+
+    def __init__(self, size=0):
+        self.bitmap = bytearray(size)
+
+    def add(self, address: int):
+        """ Record an instruction executed at the address """
+        if address >= len(self.bitmap):
+            self.bitmap.extend(bytes(address + 1 - len(self.bitmap)))
+
+        self.bitmap[address] = 1
+
+    def merge(self, other: "Coverage"):
+        """ Add all the addresses covered by another bitmap to this one """
+        if len(other.bitmap) > len(self.bitmap):
+            self.bitmap.extend(bytes(len(other.bitmap) - len(self.bitmap)))
+
+        lhs = np.frombuffer(self.bitmap, np.uint8)
+        rhs = np.frombuffer(other.bitmap, np.uint8)
+        lhs[:len(rhs)] |= rhs
+
+    def ranges(self) -> List[Tuple[int, int]]:
+        """ The covered addresses as a sorted list of [start, stop) ranges """
+        bits = np.frombuffer(self.bitmap, np.uint8).astype(np.int8)
+        edges = np.diff(np.concatenate(([0], bits, [0])))
+        starts = np.nonzero(edges == 1)[0]
+        stops = np.nonzero(edges == -1)[0]
+        return [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+
+    def __contains__(self, address):
+        return address < len(self.bitmap) and self.bitmap[address] == 1
+
+    def __len__(self):
+        return self.bitmap.count(1)
+
+
+class StopReason(IntEnum):
+    """ Reasons for which a running computer stopped """
+    Halted = 0      # The program executed a halt instruction
+    Breakpoint = 1  # The counter reached a breakpoint
+    Watchpoint = 2  # A watched address was written
+    Input = 3       # The program needs input which has not been written
+    Output = 4      # The requested number of outputs has been produced
+    Count = 5       # The requested instruction count has been reached
+
+
+class Snapshot(namedtuple("Snapshot", ["memory", "counter", "relative_base",
+                                       "instruction_count", "inputs", "outputs"])):
+    """ The complete execution state of a computer at one instant """
+
+
+class Stop(namedtuple("Stop", ["reason", "address"])):
+    """ Why the computer stopped, and the counter or memory address involved """
+
+
 class Computer:
     """ An implementation of the Intcode computer.
 
     Args:
         memory: the initial memory. Will not be modified.
+
+    Attributes:
+        breakpoints: counter values at which `resume` stops before executing
+        watchpoints: memory addresses at which `resume` stops after a write
+        journal: if started, the (instruction count, value) of each input
+                 consumed since the last reset
+        coverage: if enabled, the addresses at which instructions executed,
+                  accumulated across resets
     """
 
     def __init__(self, memory: Memory, verbose=False):
-        self._initial_memory = memory.copy()
         self._memory = Memory(memory)
+        self._reset_marker = self._memory.mark()
         self._verbose = verbose
         self._counter = 0
         self._relative_base = 0
+        self._ticks = 0
+        self._break_address = None
+        self.journal = None
+        self.coverage = None
+        self.breakpoints = set()
+        self.watchpoints = set()
         self._inputs = []
         self._outputs = []
         self._ops = {
@@ -125,28 +298,96 @@ class Computer:
 
     def print_ascii(self):
         """ Print all of the output to the console """
+        text = []
+        result = None
         while self.num_outputs:
             val = self.read()
             if val < 255:
-                sys.stdout.write(chr(val))
+                text.append(chr(val))
             else:
-                return val
+                result = val
+                break
 
-        return None
+        sys.stdout.write("".join(text))
+        return result
 
     def write_ascii(self, chars):
         """ Write all of the ASCII characters to the computer input """
-        for char in chars:
-            self.write(ord(char))
-            sys.stdout.write(char)
+        self._inputs.extend(chars.encode("ascii"))
+        sys.stdout.write(chars)
 
     def reset(self):
         """ Reset the computer """
-        self._memory = Memory(self._initial_memory)
+        self._memory.restore(self._reset_marker)
         self._inputs.clear()
         self._outputs.clear()
         self._counter = 0
         self._relative_base = 0
+        self._ticks = 0
+        self._break_address = None
+        if self.journal is not None:
+            self.journal.clear()
+
+    def start_journal(self) -> List[Tuple[int, int]]:
+        """ Start recording every input consumed by the program.
+
+        Returns:
+            the journal, a list of (instruction count, value) pairs where the
+            count is the number of instructions executed before the input
+        """
+        self.journal = []
+        return self.journal
+
+    def snapshot(self) -> Snapshot:
+        """ Capture the execution state of the computer """
+        return Snapshot(self._memory.copy(), self._counter, self._relative_base,
+                        self._ticks, list(self._inputs), list(self._outputs))
+
+    def restore(self, snapshot: Snapshot):
+        """ Return the computer to a previously captured execution state """
+        self._memory = snapshot.memory.copy()
+        self._counter = snapshot.counter
+        self._relative_base = snapshot.relative_base
+        self._ticks = snapshot.instruction_count
+        self._inputs = list(snapshot.inputs)
+        self._outputs = list(snapshot.outputs)
+        self._break_address = None
+
+    def fork(self) -> "Computer":
+        """ Create an independent computer in the same execution state """
+        other = Computer([], self._verbose)
+        other.restore(self.snapshot())
+        other._reset_marker = self._reset_marker
+        other.breakpoints = set(self.breakpoints)
+        other.watchpoints = set(self.watchpoints)
+        if self.journal is not None:
+            other.journal = list(self.journal)
+
+        if self.coverage is not None:
+            other.coverage = Coverage()
+            other.coverage.merge(self.coverage)
+
+        return other
+
+    def enable_coverage(self) -> Coverage:
+        """ Start recording the addresses at which instructions execute.
+
+        Execution is slower while coverage is enabled.
+
+        Returns:
+            the coverage bitmap
+        """
+        self.coverage = Coverage(len(self._memory.to_list()))
+        return self.coverage
+
+    @property
+    def _checked(self) -> bool:
+        return bool(self.breakpoints or self.watchpoints) or self.coverage is not None
+
+    @property
+    def instruction_count(self) -> int:
+        """ The number of instructions executed since the last reset """
+        return self._ticks
 
     def run_to_input(self):
         """ Run until the computer requests input """
@@ -167,6 +408,22 @@ class Computer:
         """ The memory of the computer """
         return self._memory.to_list()
 
+    def mark(self) -> int:
+        """ Start tracking memory writes from the current state.
+
+        Returns:
+            a marker to pass to `changes` and `release`
+        """
+        return self._memory.mark()
+
+    def changes(self, marker: int) -> List[Tuple[int, int, int]]:
+        """ The (address, old, new) triples written since the marker """
+        return self._memory.changes(marker)
+
+    def release(self, marker: int):
+        """ Stop tracking memory writes for the marker """
+        self._memory.release(marker)
+
     @property
     def ops(self) -> Mapping[int, Operation]:
         """ The operations of the computer """
@@ -176,10 +433,20 @@ class Computer:
         """ Write to the input buffer of the computer """
         self._inputs.append(value)
 
+    def write_all(self, values: List[int]):
+        """ Write several values to the input buffer of the computer """
+        self._inputs.extend(values)
+
     def read(self) -> int:
         """ Read from the output buffer of the computer """
         return self._outputs.pop(0)
 
+    def read_all(self) -> List[int]:
+        """ Read and clear the entire output buffer of the computer """
+        outputs = self._outputs
+        self._outputs = []
+        return outputs
+
     @property
     def num_outputs(self) -> bool:
         """ Returns whether the computer has produced output """
@@ -201,9 +468,13 @@ class Computer:
         """ Steps the computer forward by one instruction """
         opcode = self._memory[self._counter]
         operation = self._ops[opcode % 100]
+        if self.coverage is not None:
+            self.coverage.add(self._counter)
+
         if operation:
             self._counter = operation(
                 self._memory, self._counter, self._relative_base)
+            self._ticks += 1
 
     def run(self, noun: int = None, verb: int = None, inputs: List[int] = None):
         """ Run the computer using the program loaded in its memory.
@@ -213,7 +484,7 @@ class Computer:
             verb: an optional verb used to alter the program [None]
 
         Returns:
-            the outputs of the program
+            why and where the computer stopped
         """
         self.reset()
         if noun is not None:
@@ -229,13 +500,130 @@ class Computer:
 
         self._outputs.clear()
 
+        return self.resume()
+
+    def resume(self) -> "Stop":
+        """ Continue running from the current state.
+
+        Runs until the program halts or, if any are set, until a breakpoint
+        or watchpoint is hit. Breakpoints, watchpoints and coverage are only
+        checked while one of them is in use. Resuming from a breakpoint executes the
+        instruction it stopped on.
+
+        Returns:
+            why and where the computer stopped
+        """
+        if self._checked:
+            return self._run_checked(False, None, None)
+
         while True:
             operation = self._ops[self._memory[self._counter] % 100]
             if operation:
                 self._counter = operation(
                     self._memory, self._counter, self._relative_base)
+                self._ticks += 1
             else:
-                break
+                return Stop(StopReason.Halted, self._counter)
+
+    def run_until_blocked(self, max_outputs: int = None) -> "Stop":
+        """ Run until the computer cannot make progress without the caller.
+
+        Unlike `resume`, this never prompts the console for input.
+
+        Keyword Args:
+            max_outputs: also stop once this many outputs are buffered [None]
+
+        Returns:
+            why and where the computer stopped
+        """
+        if self._checked:
+            return self._run_checked(True, max_outputs, None)
+
+        memory = self._memory
+        ops = self._ops
+        inputs = self._inputs
+        outputs = self._outputs
+        while True:
+            counter = self._counter
+            opcode = memory[counter] % 100
+            if opcode == 3 and not inputs:
+                return Stop(StopReason.Input, counter)
+
+            operation = ops[opcode]
+            if not operation:
+                return Stop(StopReason.Halted, counter)
+
+            self._counter = operation(memory, counter, self._relative_base)
+            self._ticks += 1
+            if max_outputs is not None and len(outputs) >= max_outputs:
+                return Stop(StopReason.Output, self._counter)
+
+    def run_to_count(self, count: int) -> "Stop":
+        """ Run until the instruction count reaches the given value.
+
+        Like `run_until_blocked`, this stops early if input is needed which
+        has not been written, or if the program halts.
+
+        Returns:
+            why and where the computer stopped
+        """
+        if self._checked:
+            return self._run_checked(True, None, count)
+
+        memory = self._memory
+        ops = self._ops
+        inputs = self._inputs
+        while self._ticks < count:
+            counter = self._counter
+            opcode = memory[counter] % 100
+            if opcode == 3 and not inputs:
+                return Stop(StopReason.Input, counter)
+
+            operation = ops[opcode]
+            if not operation:
+                return Stop(StopReason.Halted, counter)
+
+            self._counter = operation(memory, counter, self._relative_base)
+            self._ticks += 1
+
+        return Stop(StopReason.Count, self._counter)
+
+    def _run_checked(self, block, max_outputs, max_count):
+        memory = self._memory
+        breakpoints = self.breakpoints
+        watchpoints = self.watchpoints
+        coverage = self.coverage
+        skip = self._break_address
+        self._break_address = None
+        while True:
+            counter = self._counter
+            if max_count is not None and self._ticks >= max_count:
+                return Stop(StopReason.Count, counter)
+
+            if counter in breakpoints and counter != skip:
+                self._break_address = counter
+                return Stop(StopReason.Breakpoint, counter)
+
+            skip = None
+            opcode = memory[counter] % 100
+            if block and opcode == 3 and not self._inputs:
+                return Stop(StopReason.Input, counter)
+
+            if coverage is not None:
+                coverage.add(counter)
+
+            operation = self._ops[opcode]
+            if not operation:
+                return Stop(StopReason.Halted, counter)
+
+            params = operation.params(memory, counter, self._relative_base)
+            self._counter = operation.call(params, memory, counter)
+            self._ticks += 1
+            if operation.num_outputs and params[-1] in watchpoints:
+                return Stop(StopReason.Watchpoint, params[-1])
+
+            if max_outputs is not None and len(self._outputs) >= max_outputs:
+                return Stop(StopReason.Output, self._counter)
 
     @staticmethod
     def add(params: List[int], memory: Memory, counter: int) -> int:
@@ -260,6 +648,9 @@ class Computer:
         else:
             value = int(input("input> "))
 
+        if self.journal is not None:
+            self.journal.append((self._ticks, value))
+
         output, = params
         memory[output] = value
         return counter + 2
@@ -381,3 +772,92 @@ def test_outputs(program, expected):
         actual.append(computer.read())
 
     np.testing.assert_array_equal(actual, expected)
+
+
+def test_changes():
+    """ Tests memory diffing against a marker """
+    computer = Computer([1, 0, 0, 0, 99])
+    marker = computer.mark()
+    computer.run()
+    assert computer.changes(marker) == [(0, 1, 2)]
+
+    computer.release(marker)
+    marker = computer.mark()
+    computer.run()
+    assert computer.changes(marker) == []
+
+
+def test_memory_restore():
+    """ Tests rolling memory back to a marker """
+    memory = Memory([1, 2, 3])
+    marker = memory.mark()
+    memory[1] = 5
+    memory[PAGE_SIZE * 3] = 7
+    assert memory.dirty_pages(marker) == [0, 3]
+    assert memory.changes(marker) == [(1, 2, 5), (PAGE_SIZE * 3, 0, 7)]
+
+    memory.restore(marker)
+    assert memory.to_list() == [1, 2, 3]
+    assert memory.changes(marker) == []
+
+
+def test_reset():
+    """ Tests that reset restores the initial program """
+    program = [1101, 100, -1, 4, 0, 0, 0, 0, 0, 0]
+    computer = Computer(program)
+    computer.run()
+    assert computer.memory[4] == 99
+    computer.reset()
+    assert computer.memory == program
+
+
+def test_breakpoints():
+    """ Tests stopping at breakpoints and resuming past them """
+    program = [1101, 1, 2, 9, 1101, 3, 4, 10, 99, 0, 0]
+    computer = Computer(program)
+    computer.breakpoints.add(4)
+    assert computer.run() == Stop(StopReason.Breakpoint, 4)
+    assert computer.memory[9:11] == [3, 0]
+    assert computer.resume() == Stop(StopReason.Halted, 8)
+    assert computer.memory[9:11] == [3, 7]
+
+
+def test_watchpoints():
+    """ Tests stopping after a watched address is written """
+    program = [1101, 1, 2, 9, 1101, 3, 4, 10, 99, 0, 0]
+    computer = Computer(program)
+    computer.watchpoints.add(10)
+    assert computer.run() == Stop(StopReason.Watchpoint, 10)
+    assert computer.memory[10] == 7
+    assert computer.resume() == Stop(StopReason.Halted, 8)
+
+
+def test_fork():
+    """ Tests that a forked computer runs independently of its parent """
+    program = [3, 100, 4, 100, 1005, 100, 0, 99]
+    computer = Computer(program)
+    computer.write(3)
+    computer.run_until_blocked()
+    fork = computer.fork()
+    fork.write(0)
+    assert fork.run_until_blocked().reason == StopReason.Halted
+    assert computer.run_until_blocked().reason == StopReason.Input
+    fork.reset()
+    assert fork.memory == program
+
+
+def test_coverage():
+    """ Tests recording executed addresses across runs """
+    program = [3, 11, 1005, 11, 7, 104, 0, 104, 1, 99, 0, 0]
+    computer = Computer(program)
+    coverage = computer.enable_coverage()
+    computer.run(inputs=[1])
+    assert coverage.ranges() == [(0, 1), (2, 3), (7, 8), (9, 10)]
+
+    other = Computer(program)
+    other.enable_coverage()
+    other.run(inputs=[0])
+    coverage.merge(other.coverage)
+    assert coverage.ranges() == [(0, 1), (2, 3), (5, 6), (7, 8), (9, 10)]
+    assert len(coverage) == 5
+    assert 5 in coverage and 1 not in coverage
@@ -0,0 +1,131 @@
+""" Rendering backends for the animated solutions """
+
+import time
+from collections import namedtuple
+
+
+class Rect(namedtuple("Rect", ["left", "top", "width", "height"])):
+    """ An axis-aligned rectangle of cells """
+
+
+class NullRenderer:
+    """ A renderer which draws nothing, for headless runs at full speed """
+
+    def map_color(self, char: str, color: str):
+        """ Map a character to a named color """
+
+    def draw(self, row: int, col: int, text: str, color: str = None):
+        """ Draw text starting at a cell """
+
+    def present(self, force=False) -> bool:
+        """ Show any changes made since the last frame """
+        return False
+
+    def is_pressed(self, key: str) -> bool:
+        """ Whether a named key is currently pressed """
+        return False
+
+    def close(self):
+        """ Close the renderer """
+
+
+class ThrottledRenderer:
+    """ Renders to a glasskey grid, redrawing only the cells which changed.
+
+    Drawing only records changes; `present` sends them to the grid at most
+    `fps` times per second, so the simulation is never slowed down to the
+    display rate unless `paced` is set.
+
+    Args:
+        rows: the number of rows in the grid
+        cols: the number of columns in the grid
+        title: the window title
+
+    Keyword Args:
+        fps: the maximum number of frames presented per second [30]
+        paced: wait for each frame instead of skipping it [False]
+    """
+
+    def __init__(self, rows: int, cols: int, title: str, fps=30, paced=False):
+        import glasskey as gk
+
+        self._gk = gk
+        self._fps = fps
+        self._paced = paced
+        self._cells = {}
+        self._dirty = {}
+        self._last_frame = None
+        gk.start()
+        self._grid = gk.create_grid(rows, cols, title)
+
+    def map_color(self, char: str, color: str):
+        """ Map a character to a named color """
+        self._grid.map_color(char, getattr(self._gk.Colors, color))
+
+    def draw(self, row: int, col: int, text: str, color: str = None):
+        """ Draw text starting at a cell """
+        for offset, char in enumerate(text):
+            cell = (row, col + offset)
+            value = (char, color)
+            if self._cells.get(cell) != value:
+                self._dirty[cell] = value
+            else:
+                self._dirty.pop(cell, None)
+
+    def present(self, force=False) -> bool:
+        """ Show any changes made since the last frame.
+
+        Keyword Args:
+            force: present even if a frame was shown too recently [False]
+
+        Returns:
+            whether a frame was presented
+        """
+        if self._paced:
+            self._gk.next_frame(self._fps)
+        elif not force and self._last_frame is not None:
+            if time.monotonic() - self._last_frame < 1 / self._fps:
+                return False
+
+        gk = self._gk
+        for (row, col), (char, color) in self._dirty.items():
+            if color is None:
+                self._grid.draw(row, col, char)
+            else:
+                self._grid.draw(row, col, [gk.Letter(char, getattr(gk.Colors, color))])
+
+        self._cells.update(self._dirty)
+        self._dirty.clear()
+        self._grid.blit()
+        self._last_frame = time.monotonic()
+        return True
+
+    def is_pressed(self, key: str) -> bool:
+        """ Whether a named key is currently pressed """
+        return self._gk.is_pressed(getattr(self._gk.Key, key))
+
+    def close(self):
+        """ Present the final frame and close the renderer """
+        self.present(force=True)
+        self._gk.stop()
+
+
+def create_renderer(rows: int, cols: int, title: str, headless=False, **kwargs):
+    """ Create a renderer.
+
+    Args:
+        rows: the number of rows in the grid
+        cols: the number of columns in the grid
+        title: the window title
+
+    Keyword Args:
+        headless: whether to draw nothing at all [False]
+        kwargs: passed to `ThrottledRenderer`
+
+    Returns:
+        a `NullRenderer` if headless, otherwise a `ThrottledRenderer`
+    """
+    if headless:
+        return NullRenderer()
+
+    return ThrottledRenderer(rows, cols, title, **kwargs)
@@ -0,0 +1,103 @@
+""" Deterministic replays of Intcode programs from their input journals """
+
+import bisect
+from typing import List, Tuple
+
+from intcode import Computer, Stop, StopReason
+
+
+class Replay:
+    """ Deterministically re-runs a program from an input journal.
+
+    Snapshots are taken every `checkpoint_interval` instructions as the
+    replay moves forward, so seeking backwards, or forwards past ground
+    already covered, only re-executes from the nearest checkpoint.
+
+    Args:
+        program: the program which produced the journal
+        journal: the (instruction count, value) input journal
+
+    Keyword Args:
+        checkpoint_interval: instructions between checkpoints [4096]
+    """
+
+    def __init__(self, program: List[int], journal: List[Tuple[int, int]],
+                 checkpoint_interval=4096):
+        self.journal = list(journal)
+        self.computer = Computer(program)
+        self.computer.write_all([value for _, value in self.journal])
+        self._interval = checkpoint_interval
+        self._checkpoints = [self.computer.snapshot()]
+        self._counts = [0]
+
+    def seek(self, count: int) -> Stop:
+        """ Move the replay to just before instruction `count` executes.
+
+        Returns:
+            a stop with reason `Count` if the count was reached, otherwise
+            the reason the program stopped before it
+        """
+        computer = self.computer
+        index = bisect.bisect_right(self._counts, count) - 1
+        if not self._counts[index] <= computer.instruction_count <= count:
+            computer.restore(self._checkpoints[index])
+
+        while True:
+            checkpoint = (computer.instruction_count // self._interval + 1) * self._interval
+            stop = computer.run_to_count(min(count, checkpoint))
+            if stop.reason != StopReason.Count:
+                return stop
+
+            reached = computer.instruction_count
+            if reached == checkpoint and reached > self._counts[-1]:
+                self._checkpoints.append(computer.snapshot())
+                self._counts.append(reached)
+
+            if reached == count:
+                return stop
+
+    @property
+    def num_checkpoints(self) -> int:
+        """ The number of checkpoints taken, including the start """
+        return len(self._checkpoints)
+
+    def seek_event(self, index: int) -> Stop:
+        """ Move the replay to just before it consumes the given journal entry """
+        return self.seek(self.journal[index][0])
+
+
+
+def test_replay():
+    """ Tests journaling inputs and seeking through a replay """
+    program = [3, 100, 4, 100, 1005, 100, 0, 99]
+    computer = Computer(program)
+    journal = computer.start_journal()
+    computer.run(inputs=[5, 6, 7, 0])
+    assert journal == [(0, 5), (3, 6), (6, 7), (9, 0)]
+
+    replay = Replay(program, journal, checkpoint_interval=4)
+    assert replay.seek_event(2) == Stop(StopReason.Count, 0)
+    assert replay.computer.read_all() == [5, 6]
+    assert replay.seek_event(1).reason == StopReason.Count
+    assert replay.computer.read_all() == [5]
+    assert replay.seek(100).reason == StopReason.Halted
+    assert replay.computer.instruction_count == 12
+
+
+def test_replay_checkpoint():
+    """ Tests seeking backwards from a checkpoint past the start """
+    program = [3, 100, 4, 100, 1005, 100, 0, 99]
+    computer = Computer(program)
+    journal = computer.start_journal()
+    computer.run(inputs=[5, 6, 7, 8, 0])
+    replay = Replay(program, journal, checkpoint_interval=4)
+    assert replay.seek(100).reason == StopReason.Halted
+    assert replay.num_checkpoints == 4
+
+    assert replay.seek_event(3).reason == StopReason.Count
+    assert replay.computer.instruction_count == 9
+    assert replay.computer.read_all() == [5, 6, 7]
+    assert replay.num_checkpoints == 4
+    assert replay.seek_event(4).reason == StopReason.Count
+    assert replay.computer.instruction_count == 12
+    assert replay.computer.read_all() == [5, 6, 7, 8]